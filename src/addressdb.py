@@ -0,0 +1,266 @@
+# SPDX-License-Identifier: MIT
+#
+# Query index over the Bern address book, in an SQLite database. To build
+# the database from the proofread volumes and to query it:
+#
+#   python3 src/addressdb.py build
+#   python3 src/addressdb.py address Kramgasse 59
+#   python3 src/addressdb.py family Aeberhard --from 1880 --to 1920
+#   python3 src/addressdb.py search 'v. Graffenried'
+#   python3 src/addressdb.py search --raw 'Uhrmacher AND Kram*'
+#   python3 src/addressdb.py near 46.9480 7.4474 --radius 100
+#
+# Besides the records table with indexes for addresses and names, the
+# database contains a full-text index over the raw proofread lines and
+# a grid index over the coordinates for finding records near a point.
+
+import argparse
+import csv
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from columnar import COLUMNS
+from process import Processor
+from sinks import SQLiteSink
+
+
+# Size of a spatial grid cell in degrees; 0.001 degrees are 111 meters
+# in latitude and about 76 meters in longitude at the latitude of Bern.
+GRID_SIZE = 0.001
+
+METERS_PER_DEGREE = 111_195.0
+
+
+def quote_fts(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def grid_cell(lat, lng):
+    if lat is None or lng is None:
+        return None
+    row = math.floor((lat + 90.0) / GRID_SIZE)
+    col = math.floor((lng + 180.0) / GRID_SIZE)
+    return row * 1_000_000 + col
+
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    # Equirectangular approximation, which is precise enough
+    # for the distances within a city.
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * METERS_PER_DEGREE * 180.0 / math.pi
+
+
+def build(path, processor, workers=1, incremental=False):
+    # Builds into a temporary file, so readers of an existing database
+    # never see a partially built one.
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    sink = SQLiteSink(tmp_path)
+    num_records = 0
+    for rec in processor.process_proofread(
+            workers=workers, incremental=incremental):
+        sink.write(rec)
+        num_records += 1
+    sink.close()
+
+    db = sqlite3.connect(tmp_path)
+    db.create_function('grid_cell', 2, grid_cell, deterministic=True)
+    # Creating the indexes after loading is much faster
+    # than keeping them up to date while inserting.
+    db.execute('CREATE INDEX records_address '
+               'ON records (Street, Housenumber, Date)')
+    db.execute('CREATE INDEX records_name ON records (Surname, Name)')
+    db.execute('CREATE TABLE grid AS '
+               'SELECT grid_cell(Latitude, Longitude) AS Cell, '
+               'rowid AS RecordID FROM records '
+               'WHERE Latitude IS NOT NULL AND Longitude IS NOT NULL')
+    db.execute('CREATE INDEX grid_cell ON grid (Cell)')
+    db.execute('CREATE VIRTUAL TABLE lines USING fts5('
+               'Text, Date UNINDEXED, PageID UNINDEXED, Page UNINDEXED)')
+    num_lines = 0
+    for volume_path in processor.volume_paths():
+        rows = list(read_raw_lines(volume_path))
+        db.executemany('INSERT INTO lines VALUES (?, ?, ?, ?)', rows)
+        num_lines += len(rows)
+    db.execute("INSERT INTO lines (lines) VALUES ('optimize')")
+    db.commit()
+    db.execute('ANALYZE')
+    db.close()
+    os.replace(tmp_path, path)
+    return num_records, num_lines
+
+
+def read_raw_lines(path):
+    page_re = re.compile(
+        r'^# Date: (\d{4}-\d\d-\d\d) Page: (\d+)/([\[\]\d]+)$')
+    date, page_id, page_label = None, None, None
+    with open(path) as stream:
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            if m := page_re.match(line):
+                date, page_id, page_label = m.groups()
+                continue
+            yield (line, date, page_id, page_label)
+
+
+class AddressDB(object):
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f'{path} not found, run "addressdb.py build" first')
+        self.db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        self.select = 'SELECT %s FROM records' % ', '.join(COLUMNS)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def address(self, street, housenumber=None):
+        if housenumber is None:
+            return self.db.execute(
+                f'{self.select} WHERE Street = ? '
+                'ORDER BY Housenumber, Date', (street,)).fetchall()
+        return self.db.execute(
+            f'{self.select} WHERE Street = ? AND Housenumber = ? '
+            'ORDER BY Date', (street, housenumber)).fetchall()
+
+    def family(self, surname, name=None, first_year=None, last_year=None):
+        query = f'{self.select} WHERE Surname = ?'
+        params = [surname]
+        if name is not None:
+            query += ' AND Name = ?'
+            params.append(name)
+        # The Date column is ISO 8601, so whole years compare as strings.
+        if first_year is not None:
+            query += ' AND Date >= ?'
+            params.append(f'{first_year:04d}')
+        if last_year is not None:
+            query += ' AND Date < ?'
+            params.append(f'{last_year + 1:04d}')
+        query += ' ORDER BY Date, Name'
+        return self.db.execute(query, params).fetchall()
+
+    def search(self, text, limit=100, raw=False):
+        # Unless raw is set, every word of text gets searched for as it
+        # is, so that "v. Graffenried" does not trip the FTS5 query syntax.
+        if not raw:
+            text = ' '.join(quote_fts(t) for t in text.split())
+        return self.db.execute(
+            'SELECT Text, Date, PageID, Page FROM lines WHERE lines MATCH ? '
+            'ORDER BY rank LIMIT ?', (text, limit)).fetchall()
+
+    def near(self, lat, lng, radius):
+        # Looks up the grid cells overlapping the bounding box of the
+        # circle, then filters the records in these cells by distance.
+        dlat = radius / METERS_PER_DEGREE
+        dlng = dlat / max(math.cos(math.radians(lat)), 1e-9)
+        lo, hi = grid_cell(lat - dlat, lng - dlng), grid_cell(lat + dlat, lng + dlng)
+        cells = [row + col
+                 for row in range(lo // 1_000_000 * 1_000_000,
+                                  hi // 1_000_000 * 1_000_000 + 1, 1_000_000)
+                 for col in range(lo % 1_000_000, hi % 1_000_000 + 1)]
+        placeholders = ', '.join('?' * len(cells))
+        rows = self.db.execute(
+            f'{self.select} WHERE rowid IN '
+            f'(SELECT RecordID FROM grid WHERE Cell IN ({placeholders}))',
+            cells).fetchall()
+        lat_col, lng_col = COLUMNS.index('Latitude'), COLUMNS.index('Longitude')
+        result = []
+        for row in rows:
+            d = distance_meters(lat, lng, row[lat_col], row[lng_col])
+            if d <= radius:
+                result.append((d, row))
+        result.sort(key=lambda r: (r[0], r[1][COLUMNS.index('Date')]))
+        return [row for _, row in result]
+
+
+def write_rows(header, rows):
+    out = csv.writer(sys.stdout)
+    out.writerow(header)
+    out.writerows(rows)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--db', default='bern-address-book.db',
+                           help='path to database; default: %(default)s')
+    subparsers = argparser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser(
+        'build', help='build the database from the proofread volumes')
+    build_parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of worker processes; 0 for one per CPU')
+    build_parser.add_argument(
+        '--incremental', action='store_true',
+        help='only re-parse volumes that changed since the last run')
+    build_parser.add_argument(
+        '--fuzzy-streets', action='store_true',
+        help='also match street names that were damaged by OCR')
+    address_parser = subparsers.add_parser(
+        'address', help='who lived at an address over time')
+    address_parser.add_argument('street')
+    address_parser.add_argument('housenumber', nargs='?')
+    family_parser = subparsers.add_parser(
+        'family', help='all entries for a family name')
+    family_parser.add_argument('surname')
+    family_parser.add_argument('--name', help='given name')
+    family_parser.add_argument('--from', dest='first_year', type=int)
+    family_parser.add_argument('--to', dest='last_year', type=int)
+    search_parser = subparsers.add_parser(
+        'search', help='full-text search over the raw proofread lines')
+    search_parser.add_argument('text', help='words to search for')
+    search_parser.add_argument('--limit', type=int, default=100)
+    search_parser.add_argument(
+        '--raw', action='store_true',
+        help='pass text as an FTS5 query, such as \'Uhrmacher NOT Bern*\'')
+    near_parser = subparsers.add_parser(
+        'near', help='entries within a radius around a point')
+    near_parser.add_argument('lat', type=float)
+    near_parser.add_argument('lng', type=float)
+    near_parser.add_argument('--radius', type=float, default=50.0,
+                             help='radius in meters; default: %(default)s')
+    args = argparser.parse_args()
+
+    start_time = time.perf_counter()
+    if args.command == 'build':
+        p = Processor(cachedir='cache', fuzzy_streets=args.fuzzy_streets)
+        num_records, num_lines = build(
+            args.db, p, workers=args.workers or os.cpu_count(),
+            incremental=args.incremental)
+        print(f'{args.db}: {num_records} records, {num_lines} lines, '
+              f'{time.perf_counter() - start_time:.1f}s', file=sys.stderr)
+        sys.exit(0)
+
+    with AddressDB(args.db) as adb:
+        if args.command == 'address':
+            rows = adb.address(args.street, args.housenumber)
+            write_rows(COLUMNS, rows)
+        elif args.command == 'family':
+            rows = adb.family(args.surname, args.name,
+                              args.first_year, args.last_year)
+            write_rows(COLUMNS, rows)
+        elif args.command == 'search':
+            try:
+                rows = adb.search(args.text, args.limit, raw=args.raw)
+            except sqlite3.OperationalError as e:
+                print(f'error: bad search query: {e}', file=sys.stderr)
+                sys.exit(2)
+            write_rows(['Text', 'Date', 'PageID', 'Page'], rows)
+        elif args.command == 'near':
+            rows = adb.near(args.lat, args.lng, args.radius)
+            write_rows(COLUMNS, rows)
+    print(f'{len(rows)} rows, {(time.perf_counter() - start_time) * 1000:.1f}ms',
+          file=sys.stderr)
@@ -0,0 +1,411 @@
+# SPDX-License-Identifier: MIT
+#
+# Benchmarks for the Bern address book pipeline. Benchmarks that compare
+# peak memory usage run each variant in a fresh subprocess.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as etree
+
+from fetch import (ALTO_SPACE, ALTO_STRING, ALTO_TEXTLINE, Chapter,
+                   Extractor, Page, read_alto_lines)
+from process import Processor, normalize_phone, read_lines
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'cleanup'))
+import check_charset
+
+
+# Fixed slices of the corpus, one for each era of the address book:
+# no phone numbers, trailing phone numbers (1900-1917), and phone
+# numbers in brackets (1941 and later).
+SUITE_VOLUMES = ['1861-04-15', '1900-02-15', '1943-12-15']
+
+
+ALTO_NAMESPACE = 'http://www.loc.gov/standards/alto/ns-v3#'
+
+
+def read_proofread_pages(volume):
+    # Returns the lines of text on every page of a proofread volume,
+    # grouped by page.
+    path = os.path.join(
+        os.path.dirname(__file__), '..', 'proofread', f'{volume}.txt')
+    pages = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('# Date:'):
+                pages.append([])
+            elif line.strip():
+                pages[-1].append(line.strip())
+    return pages
+
+
+def make_alto_page(lines):
+    # Synthesizes an ALTO page with one TextLine for every line of text,
+    # with attributes similar to those in the e-rara.ch files. This lets
+    # the extraction benchmarks run without a page cache.
+    etree.register_namespace('', ALTO_NAMESPACE)
+    ns = '{' + ALTO_NAMESPACE + '}'
+    alto = etree.Element(ns + 'alto')
+    layout = etree.SubElement(alto, ns + 'Layout')
+    page = etree.SubElement(layout, ns + 'Page', ID='p1')
+    space = etree.SubElement(page, ns + 'PrintSpace')
+    block = etree.SubElement(space, ns + 'TextBlock', ID='b1')
+    for i, line in enumerate(lines):
+        text_line = etree.SubElement(
+            block, ns + 'TextLine', ID=f'l{i}', HPOS='120',
+            VPOS=str(100 + 40 * i), WIDTH='1500', HEIGHT='38')
+        for j, word in enumerate(line.split()):
+            if j > 0:
+                etree.SubElement(text_line, ns + 'SP')
+            etree.SubElement(
+                text_line, ns + 'String', ID=f'l{i}w{j}', CONTENT=word,
+                HPOS=str(120 + 90 * j), VPOS=str(100 + 40 * i),
+                WIDTH='85', HEIGHT='38', WC='0.93', CC='9 8 9 7')
+    return etree.tostring(alto, encoding='utf-8', xml_declaration=True)
+
+
+def read_alto_lines_with_tree(data):
+    # How fetch.Extractor.process_page used to read ALTO pages,
+    # kept here as a baseline for comparison.
+    et = etree.fromstring(data)
+    for line in et.findall(f'.//{ALTO_TEXTLINE}'):
+        tokens = []
+        for e in line:
+            if e.tag == ALTO_STRING:
+                tokens.append(e.attrib['CONTENT'])
+            elif e.tag == ALTO_SPACE:
+                tokens.append(' ')
+        yield ''.join(tokens)
+
+
+def extract_pages(method, pages, repeat):
+    read_lines = {
+        'tree': read_alto_lines_with_tree,
+        'streaming': read_alto_lines,
+    }[method]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        digest = hashlib.sha256()
+        for page in pages:
+            for line in read_lines(page):
+                digest.update(line.encode('utf-8'))
+    return digest.hexdigest(), time.perf_counter() - start
+
+
+def peak_rss():
+    # In KiB. On Linux, ru_maxrss survives exec, so a freshly spawned
+    # process would report the peak of its parent; VmHWM does not.
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def split_phone_inline(publication_date, line):
+    # How process.Processor.split_phone used to work before parse plans,
+    # kept here as a baseline for comparison.
+    year = int(publication_date[:4])
+    phone = None
+    if year >= 1900 and year <= 1917:
+        if m := re.match(r'^(.+\d(\s?[a-f])?) (\d{2,4})$', line):
+            line, _, phone = m.groups()
+            phone = [phone]
+    elif year >= 1941:
+        if m := re.findall(r'\[((\d\s*){5})\]', line):
+            phone = [normalize_phone(p[0], year) for p in m]
+        line = re.sub(r'\s?\[.+?\]', '', line)
+    return phone, line
+
+
+def split_address_inline(addresses, line):
+    # How process.Processor.split_address used to work before parse plans,
+    # kept here as a baseline for comparison.
+    for suffix in ['Bümpliz', 'Riedbach', 'Oberbottigen', ', ']:
+        line = line.removesuffix(suffix)
+    frags = line.split(',')
+    tokens = frags[-1].strip().split(' ')
+    if len(tokens) < 2:
+        return None, line
+    street, housenumber = tokens[-2], tokens[-1]
+    if street and street[-1] == '.':
+        for abbr, full in [('w.', 'weg'), ('str.', 'strasse')]:
+            if street.endswith(abbr):
+                street = street.removesuffix(abbr) + full
+                break
+    if addr := addresses.get((street, housenumber)):
+        return addr, ' '.join(tokens[:-2]).removesuffix(',')
+    return None, line
+
+
+def collect_phone_inputs(processor, volume):
+    # Returns what split_phone gets to see for every record of a volume.
+    path = os.path.join(
+        os.path.dirname(__file__), '..', 'proofread', f'{volume}.txt')
+    inputs = []
+    split_phone = processor.split_phone
+    def capture(line):
+        inputs.append(line)
+        return split_phone(line)
+    processor.split_phone = capture
+    for _ in processor.process_volume(path):
+        pass
+    del processor.split_phone
+    return processor.publication_date, inputs
+
+
+def bench_parse(args):
+    p = Processor(cachedir='cache')
+    print('Volume       Records  Inline (µs/rec)  Plan (µs/rec)')
+    for volume in args.volume:
+        date, inputs = collect_phone_inputs(p, volume)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for line in inputs:
+                phone, rest = split_phone_inline(date, line)
+                split_address_inline(p.addresses, rest)
+        inline_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            p.parse_plan = p.get_parse_plan(date)
+            for line in inputs:
+                phone, rest = p.split_phone(line)
+                p.split_address(rest)
+        plan_seconds = time.perf_counter() - start
+        n = len(inputs) * args.repeat
+        print('%s %8d %16.3f %14.3f' % (volume, len(inputs),
+              inline_seconds * 1e6 / n, plan_seconds * 1e6 / n))
+
+
+def traced_lines(lines, totals):
+    # Yields lines while tracemalloc measures, for each line, how far
+    # memory rose above its level before the line got read. The peak
+    # gets reset for every line, so short-lived strings count too.
+    lines = iter(lines)
+    while True:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        line = next(lines, None)
+        if line is None:
+            return
+        yield line
+        totals['lines'] += 1
+        totals['peak_bytes'] += tracemalloc.get_traced_memory()[1] - base
+
+
+def bench_alloc(args):
+    p = Processor(cachedir='cache')
+    if args.volume:
+        paths = [os.path.join(os.path.dirname(__file__), '..', 'proofread',
+                              f'{v}.txt') for v in args.volume]
+    else:
+        paths = p.volume_paths()
+    totals = {'lines': 0, 'peak_bytes': 0}
+    records = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    for path in paths:
+        lines = traced_lines(read_lines(path), totals)
+        records.extend(p.process_lines(lines, path))
+    seconds = time.perf_counter() - start
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Blocks still allocated once parsing is done are mostly the emitted
+    # records, so their size per record is what a consumer has to hold.
+    print(f'volumes: {len(paths)}; lines: {totals["lines"]}; '
+          f'input records: {p.num_input_records}; '
+          f'output records: {len(records)}')
+    print(f'allocated per input record: '
+          f'{totals["peak_bytes"] / max(p.num_input_records, 1):.1f} bytes')
+    print(f'retained per output record: '
+          f'{retained / max(len(records), 1):.1f} bytes')
+    print(f'seconds under tracemalloc: {seconds:.1f}')
+
+
+def measured(func, *args):
+    result, seconds = func(*args)
+    return result, seconds, peak_rss()
+
+
+def measure_in_subprocess(func, *args):
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=ctx) as executor:
+        return executor.submit(measured, func, *args).result()
+
+
+def bench_extract(args):
+    # The pages get synthesized here, not in the subprocess, because
+    # building them would otherwise dominate the peak memory usage.
+    pages = read_proofread_pages(args.volume)[:args.pages * args.merge]
+    pages = [make_alto_page(sum(pages[i:i + args.merge], []))
+             for i in range(0, len(pages), args.merge)]
+    results = {}
+    print('Method        Seconds  Peak RSS (MiB)')
+    for method in ('tree', 'streaming'):
+        digest, seconds, peak_rss = measure_in_subprocess(
+            extract_pages, method, pages, args.repeat)
+        results[method] = digest
+        print('%-12s %8.3f %15.1f' % (method, seconds, peak_rss / 1024.0))
+    if results['tree'] != results['streaming']:
+        raise ValueError('streaming extraction differs from tree extraction')
+
+
+def suite_startup():
+    start = time.perf_counter()
+    Processor(cachedir='cache')
+    return {}, time.perf_counter() - start
+
+
+def suite_volume(volume):
+    path = os.path.join(
+        os.path.dirname(__file__), '..', 'proofread', f'{volume}.txt')
+    p = Processor(cachedir='cache')
+    start = time.perf_counter()
+    num_output_records = sum(1 for _ in p.process_volume(path))
+    seconds = time.perf_counter() - start
+    num_input_records = p.num_input_records
+    # A second, instrumented pass for the time spent in each stage;
+    # instrumentation slows parsing down, so it is not timed itself.
+    p.reset_stats()
+    p.instrument = True
+    for _ in p.process_volume(path):
+        pass
+    result = {
+        'records': num_input_records,
+        'output_records': num_output_records,
+        'stages': {stage: round(t, 6)
+                   for stage, t in sorted(p.stage_seconds.items())},
+    }
+    return result, seconds
+
+
+def suite_extract(pages):
+    with tempfile.TemporaryDirectory() as cachedir:
+        ex = Extractor(cachedir)
+        chapter = Chapter(id=0, title='', date='1900-02-15', year='1900',
+                          volume=0, pages=[])
+        for i, page in enumerate(pages):
+            ex.store.put(f'fulltext-{i}', page)
+        start = time.perf_counter()
+        out = io.StringIO()
+        for i in range(len(pages)):
+            ex.process_page(chapter, Page(id=i, label=str(i)), out)
+        seconds = time.perf_counter() - start
+    return {'records': len(pages)}, seconds
+
+
+def suite_charset():
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = check_charset.check()
+    seconds = time.perf_counter() - start
+    return {'records': sum(total for _, total in stats.values())}, seconds
+
+
+def bench_suite(args):
+    pages = [make_alto_page(p) for p in read_proofread_pages('1900-02-15')]
+    cases = [('startup', suite_startup, ())]
+    cases.extend((f'process {v}', suite_volume, (v,)) for v in SUITE_VOLUMES)
+    cases.append(('extract pages', suite_extract, (pages[:args.pages],)))
+    cases.append(('check charset', suite_charset, ()))
+    # Make sure the lookup table snapshot exists before timing startup.
+    measure_in_subprocess(suite_startup)
+    results = {}
+    print('Benchmark            Seconds   Records/s  Peak RSS (MiB)')
+    for name, func, func_args in cases:
+        runs = [measure_in_subprocess(func, *func_args)
+                for _ in range(args.repeat)]
+        # The fastest run is the one least disturbed by other processes.
+        result, seconds, rss = min(runs, key=lambda run: run[1])
+        result['seconds'] = round(seconds, 6)
+        result['peak_rss_kib'] = max(run[2] for run in runs)
+        if 'records' in result:
+            result['records_per_second'] = round(result['records'] / seconds, 1)
+        results[name] = result
+        print('%-18s %9.3f %11s %15.1f' % (
+            name, seconds, result.get('records_per_second', ''),
+            result['peak_rss_kib'] / 1024.0))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(baseline, results, args.threshold)
+        for regression in regressions:
+            print(f'regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+def find_regressions(baseline, results, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ('seconds', 'peak_rss_kib'):
+            old, new = baseline[name][metric], result[metric]
+            if new > old * (1.0 + threshold):
+                regressions.append(
+                    f'{name} {metric}: {old} -> {new} '
+                    f'(+{(new / old - 1.0) * 100.0:.0f}%)')
+    return regressions
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(dest='benchmark', required=True)
+    extract = subparsers.add_parser(
+        'extract', help='ALTO page extraction, tree versus streaming')
+    extract.add_argument('--volume', default='1900-02-15')
+    extract.add_argument('--pages', type=int, default=100)
+    extract.add_argument(
+        '--merge', type=int, default=1,
+        help='merge this many pages into one, to simulate large pages')
+    extract.add_argument('--repeat', type=int, default=3)
+    extract.set_defaults(func=bench_extract)
+    parse = subparsers.add_parser(
+        'parse', help='split_phone and split_address, per record')
+    parse.add_argument(
+        '--volume', action='append',
+        help='volume to parse, such as 1900-02-15; may be repeated')
+    parse.add_argument('--repeat', type=int, default=3)
+    parse.set_defaults(func=bench_parse)
+    alloc = subparsers.add_parser(
+        'alloc', help='memory allocated while parsing, per record')
+    alloc.add_argument(
+        '--volume', action='append',
+        help='volume to parse, such as 1900-02-15; may be repeated; '
+             'default: all volumes')
+    alloc.set_defaults(func=bench_alloc)
+    suite = subparsers.add_parser(
+        'suite', help='end-to-end and per-stage benchmarks on fixed volumes')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--pages', type=int, default=50,
+                       help='number of synthesized ALTO pages to extract')
+    suite.add_argument('--save', metavar='PATH',
+                       help='write results as JSON, e.g. to use as baseline')
+    suite.add_argument('--baseline', metavar='PATH',
+                       help='fail if results are worse than this baseline')
+    suite.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='tolerated slowdown or memory growth; default 0.2 = 20%%')
+    suite.set_defaults(func=bench_suite)
+    args = argparser.parse_args()
+    if args.benchmark == 'parse' and not args.volume:
+        args.volume = ['1861-04-15', '1900-02-15', '1943-12-15']
+    args.func(args)
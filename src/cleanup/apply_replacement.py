@@ -1,8 +1,13 @@
+import argparse
+import difflib
+import multiprocessing
 import os
 import re
+import sys
+from collections import Counter
 
 FIXES = [
-    ('(g|G)ehiilf', '\g<1>ehülf'),
+    ('(g|G)ehiilf', r'\g<1>ehülf'),
     ('Herrn\.', 'Herm.'),
     ('Job\.', 'Joh.'),
     #(r'£(\d\d+)', '↯\g<1>'),
@@ -13,19 +18,231 @@ FIXES = [
 ]
 
 
-def apply_replacements():
+class ReplacementEngine(object):
+    # Applies the rules in the order of FIXES, like running re.sub once
+    # per rule, but combining consecutive rules into one regular
+    # expression where their matches do not get in each other's way.
+    # Each rule in a combined expression is a named group "r<index>",
+    # so a match tells which rule it belongs to.
+    #
+    # A combined pass takes the leftmost match of any rule, whereas
+    # running the rules one by one lets an earlier rule win even where
+    # a later rule matches further left. For example, the rules bc -> X
+    # and ab -> Y turn "abc" into "aX" when run one by one, but into "Yc"
+    # when combined. Hence, the rules that match a text get combined only
+    # as long as their matches in the text do not overlap; a rule whose
+    # matches overlap those of an earlier rule starts a new pass, which
+    # sees the output of the previous one. Within a pass, the output of
+    # one rule is not fed to another one, such as when a deletion joins
+    # text that a later rule would match; none of the rules in FIXES
+    # needs that.
+    #
+    # Rules that cannot be embedded in a larger expression, because they
+    # set global flags such as (?m) or refer to their own groups inside
+    # the pattern, split FIXES into segments, and get applied between
+    # them with a re.sub pass of their own.
+    def __init__(self, fixes):
+        self.fixes = fixes
+        self.rules = [re.compile(fro) for fro, _ in fixes]
+        # Replacements without backslashes need no group expansion.
+        self.literals = [None if '\\' in to else to for _, to in fixes]
+        # Runs of combinable rules, and non-combinable rules on their own.
+        self.segments = []
+        for i, rule in enumerate(self.rules):
+            if not can_combine(rule):
+                self.segments.append((False, (i,)))
+            elif self.segments and self.segments[-1][0]:
+                self.segments[-1] = (True, self.segments[-1][1] + (i,))
+            else:
+                self.segments.append((True, (i,)))
+        self.combined = {}
+
+    def combine(self, active):
+        # Combined expressions are much slower to search than single ones,
+        # because the regex engine cannot skip ahead to a literal prefix.
+        # Hence, only the rules that occur in a text get combined.
+        if not (entry := self.combined.get(active)):
+            regexp = re.compile('|'.join(
+                f'(?P<r{i}>{self.fixes[i][0]})' for i in active))
+            # Group numbers in the combined expression differ from those
+            # in the rule, so replacements get rewritten to use the former.
+            templates = {
+                i: shift_groups(self.fixes[i][1], regexp.groupindex[f'r{i}'])
+                for i in active if self.literals[i] is None}
+            entry = self.combined[active] = (regexp, templates)
+        return entry
+
+    def apply(self, text):
+        hits = Counter()
+        for combinable, indices in self.segments:
+            if not combinable:
+                text = self.apply_single(indices[0], text, hits)
+                continue
+            active = [i for i in indices if self.rules[i].search(text)]
+            while active:
+                batch, active = self.next_batch(active, text)
+                if len(batch) == 1:
+                    text = self.apply_single(batch[0], text, hits)
+                else:
+                    text = self.apply_combined(batch, text, hits)
+        return text, hits
+
+    def next_batch(self, active, text):
+        # Splits off the leading rules whose matches in text do not
+        # overlap each other, which may therefore be applied together.
+        if len(active) == 1:
+            return active, []
+        spans = []
+        for k, i in enumerate(active):
+            rule_spans = [m.span() for m in self.rules[i].finditer(text)]
+            merged = sorted(spans + rule_spans)
+            if k > 0 and any(merged[j][1] > merged[j + 1][0]
+                             for j in range(len(merged) - 1)):
+                return active[:k], active[k:]
+            spans = merged
+        return active, []
+
+    def apply_single(self, i, text, hits):
+        text, n = self.rules[i].subn(self.fixes[i][1], text)
+        if n:
+            hits[i] += n
+        return text
+
+    def apply_combined(self, batch, text, hits):
+        regexp, templates = self.combine(tuple(batch))
+
+        def replace(m):
+            i = int(m.lastgroup[1:])
+            hits[i] += 1
+            if (literal := self.literals[i]) is not None:
+                return literal
+            return m.expand(templates[i])
+
+        return regexp.sub(replace, text)
+
+
+def can_combine(rule):
+    # Global flags are only allowed at the start of an expression,
+    # backreferences such as \1 would point to another rule's group,
+    # and group names might clash with those of other rules.
+    if rule.flags & ~re.UNICODE or rule.groupindex:
+        return False
+    return not has_backreference(rule.pattern)
+
+
+def has_backreference(pattern):
+    # Looks for \1 to \99, (?P=name) and (?(1)...), but not inside
+    # character sets, where \1 stands for a character.
+    i, in_set = 0, False
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if not in_set and pattern[i + 1:i + 2].isdigit() and \
+                    pattern[i + 1] != '0':
+                return True
+            i += 2
+            continue
+        if in_set:
+            in_set = c != ']'
+        elif c == '[':
+            in_set = True
+            # A ] right after [ or [^ is part of the set.
+            if pattern.startswith(']', i + 1):
+                i += 1
+            elif pattern.startswith('^]', i + 1):
+                i += 2
+        elif pattern.startswith(('(?P=', '(?('), i):
+            return True
+        i += 1
+    return False
+
+
+def shift_groups(template, offset):
+    # Rewrites the group references of a replacement, such as \1 or
+    # \g<1>, so they refer to the groups of the rule inside a combined
+    # expression whose group for the whole rule is number offset.
+    def shift(m):
+        ref = m.group(1)
+        if ref == '\\' or ref.startswith('0'):
+            return m.group(0)
+        if ref.startswith('g<'):
+            ref = ref[2:-1]
+        return f'\\g<{int(ref) + offset}>'
+    return re.sub(r'\\(\\|\d\d?|g<[^>]*>)', shift, template)
+
+
+ENGINE = ReplacementEngine(FIXES)
+
+
+def volume_paths():
     dirpath = os.path.join(os.path.dirname(__file__), '..', '..', 'proofread')
-    print(dirpath)
+    paths = []
     for filename in sorted(os.listdir(dirpath)):
-        if not filename.endswith('.txt'):
-            continue
-        path = os.path.join(dirpath, filename)
-        with open(path, 'r') as f:
-            content = f.read()
-        for (fro, to) in FIXES:
-            content = re.sub(fro, to, content)
-        with open(path, 'w') as f:
-            f.write(content)
+        if filename.endswith('.txt'):
+            paths.append(os.path.join(dirpath, filename))
+    return paths
+
+
+def apply_file(path, dry_run=False):
+    with open(path, 'r') as f:
+        content = f.read()
+    fixed, hits = ENGINE.apply(content)
+    if fixed == content:
+        return hits, False, None
+    name = os.path.relpath(path)
+    diff = ''.join(difflib.unified_diff(
+        content.splitlines(keepends=True), fixed.splitlines(keepends=True),
+        fromfile=name, tofile=name)) if dry_run else None
+    if not dry_run:
+        with open(path + '.tmp', 'w') as f:
+            f.write(fixed)
+        os.rename(path + '.tmp', path)  # atomic
+    return hits, True, diff
+
+
+def apply_file_job(args):
+    return apply_file(*args)
+
+
+def apply_files(jobs, workers):
+    if workers == 1 or len(jobs) < 2:
+        yield from map(apply_file_job, jobs)
+        return
+    # Pool.imap returns results in the order of its input,
+    # so diffs come out in the same order as in a serial run.
+    with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+        yield from pool.imap(apply_file_job, jobs)
+
+
+def apply_replacements(workers=1, dry_run=False, out=sys.stdout):
+    jobs = [(path, dry_run) for path in volume_paths()]
+    total_hits = Counter()
+    num_changed = 0
+    for hits, changed, diff in apply_files(jobs, workers):
+        total_hits.update(hits)
+        num_changed += changed
+        if diff:
+            out.write(diff)
+    return num_changed, len(jobs), total_hits
+
+
+def print_hits(hits, file):
+    print('   Hits  Rule', file=file)
+    for i, (fro, to) in enumerate(FIXES):
+        print('%7d  %s -> %s' % (hits[i], fro, to), file=file)
+
 
 if __name__ == '__main__':
-    apply_replacements()
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--dry-run', action='store_true',
+        help='print a diff of the changes instead of applying them')
+    argparser.add_argument(
+        '--workers', type=int, default=0,
+        help='number of worker processes; default: one per CPU')
+    args = argparser.parse_args()
+    num_changed, num_files, hits = apply_replacements(
+        workers=args.workers or os.cpu_count(), dry_run=args.dry_run)
+    verb = 'would change' if args.dry_run else 'changed'
+    print(f'{verb} {num_changed} of {num_files} files', file=sys.stderr)
+    print_hits(hits, file=sys.stderr)
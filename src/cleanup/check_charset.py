@@ -2,12 +2,23 @@
 # SPDX-License-Identifier: MIT
 #
 # Check how many records contain unexpected characters.
+#
+# With --json, the problems get written as one JSON object per line,
+# with file, line and column, for editors and other tools; the summary
+# table then goes to standard error. With --incremental, volumes that
+# have not changed since the last run do not get checked again.
 
 
 import argparse
 
 from collections import Counter
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
+import re
+import sys
 
 
 ALLOWED_CHARS = set(
@@ -15,38 +26,176 @@ ALLOWED_CHARS = set(
     'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
     'abcdefghijklmnopqrstuvwxyzäöüéèß')
 
+BRACKETS = [('(', ')'), ('[', ']'), ('«', '»')]
+_BRACKET_RES = [re.compile('[%s%s]' % (re.escape(o), re.escape(c)))
+                for o, c in BRACKETS]
+
+# Bump whenever a change to the checker can change its results,
+# so that results cached by incremental runs get invalidated.
+CHECKER_VERSION = 1
+
+# Finds the first character that is a bracket or not allowed at all.
+# Most lines have neither, so one regex search settles them; measured
+# on the full corpus, this is faster than str.translate or re.fullmatch.
+_BRACKET_CHARS = {c for pair in BRACKETS for c in pair}
+_SUSPICIOUS_RE = re.compile(
+    '[^%s]' % ''.join(re.escape(c)
+                      for c in sorted(ALLOWED_CHARS - _BRACKET_CHARS)))
+
+_BAD_CHAR_RE = re.compile(
+    '[^%s]' % ''.join(re.escape(c) for c in sorted(ALLOWED_CHARS)))
 
-def check():
+
+def volume_paths():
     dirpath = os.path.join(os.path.dirname(__file__), '..', '..', 'proofread')
+    paths = []
+    for filename in sorted(os.listdir(dirpath)):
+        if filename.endswith('.txt'):
+            paths.append(os.path.join(dirpath, filename))
+    return paths
+
+
+def check(workers=1, cache_path=None, output='text'):
     stats = {}
     exceptions = read_exceptions()
-    for filename in sorted(os.listdir(dirpath)):
-        if not filename.endswith('.txt'):
-            continue
-        date = filename.removesuffix('.txt')
-        year = int(date[:4])
-        # if year != 1935: continue
-        num_records = 0
-        num_bad_records = 0
-        with open(os.path.join(dirpath, filename)) as f:
-            for line in f:
-                start_char = line[0]
-                if start_char == '#':
-                    continue
-                num_records += 1
-                ok = line.endswith('\n')
-                line = line[:-1]
-                ok = ok and all(c in ALLOWED_CHARS for c in line)
-                ok = ok and line.count('(') == line.count(')')
-                ok = ok and line.count('[') == line.count(']')
-                ok = ok and line.count('«') == line.count('»')
-                if not ok and line not in exceptions:
-                    num_bad_records += 1
-                    print(line)
-        stats[date] = (num_bad_records, num_records)
+    results = check_volumes(volume_paths(), exceptions, workers, cache_path)
+    for path, result in results.items():
+        date = os.path.basename(path).removesuffix('.txt')
+        stats[date] = (result['bad_records'], result['records'])
+        for line_num, text, problems in result['bad_lines']:
+            if output == 'json':
+                for column, message in problems:
+                    print(json.dumps({
+                        'file': os.path.relpath(path),
+                        'line': line_num,
+                        'column': column,
+                        'message': message,
+                        'text': text,
+                    }, ensure_ascii=False))
+            else:
+                print(text)
     return stats
 
 
+def check_volumes(paths, exceptions, workers, cache_path):
+    cache = read_cache(cache_path, exceptions) if cache_path else {}
+    results, todo = {}, []
+    for path in paths:
+        stamp = file_stamp(path)
+        cached = cache.get(os.path.basename(path))
+        if cached and cached['stamp'] == stamp:
+            results[path] = cached['result']
+        else:
+            todo.append(path)
+    check_func = functools.partial(check_file, exceptions=exceptions)
+    if workers == 1 or len(todo) < 2:
+        checked = map(check_func, todo)
+        results.update(zip(todo, checked))
+    else:
+        with multiprocessing.Pool(min(workers, len(todo))) as pool:
+            results.update(zip(todo, pool.map(check_func, todo)))
+    if cache_path and todo:
+        write_cache(cache_path, exceptions, {
+            os.path.basename(path): {'stamp': file_stamp(path),
+                                     'result': results[path]}
+            for path in paths
+        })
+    return {path: results[path] for path in paths}
+
+
+def check_file(path, exceptions):
+    num_records = 0
+    bad_lines = []
+    suspicious = _SUSPICIOUS_RE.search
+    with open(path) as f:
+        for line_num, line in enumerate(f, 1):
+            if line[0] == '#':
+                continue
+            num_records += 1
+            has_newline = line.endswith('\n')
+            if has_newline:
+                line = line[:-1]
+            if has_newline and (not suspicious(line) or is_good(line)):
+                continue
+            if line in exceptions:
+                continue
+            problems = find_problems(line)
+            if not has_newline:
+                problems.append((len(line) + 1, 'missing newline at end of file'))
+            bad_lines.append((line_num, line, problems))
+    return {'records': num_records, 'bad_records': len(bad_lines),
+            'bad_lines': bad_lines}
+
+
+def is_good(line):
+    if _BAD_CHAR_RE.search(line):
+        return False
+    for open_char, close_char in BRACKETS:
+        if line.count(open_char) != line.count(close_char):
+            return False
+    return True
+
+
+def find_problems(line):
+    # Columns are 1-based, as in the diagnostics of most compilers.
+    problems = [(m.start() + 1, f'unexpected character {m.group()!r} '
+                                f'(U+{ord(m.group()):04X})')
+                for m in _BAD_CHAR_RE.finditer(line)]
+    for (open_char, close_char), bracket_re in zip(BRACKETS, _BRACKET_RES):
+        if line.count(open_char) == line.count(close_char):
+            continue
+        # Points at the first closing bracket without an opening one,
+        # or else at the last opening bracket that never gets closed.
+        unclosed = []
+        column = None
+        for m in bracket_re.finditer(line):
+            if m.group() == open_char:
+                unclosed.append(m.start())
+            elif not unclosed:
+                column = m.start()
+                break
+            else:
+                unclosed.pop()
+        if column is None:
+            column = unclosed[-1] if unclosed else 0
+        problems.append(
+            (column + 1, f'unbalanced {open_char}{close_char} brackets'))
+    problems.sort()
+    return problems
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def cache_key(exceptions):
+    key = hashlib.sha256()
+    key.update(f'{CHECKER_VERSION}\n'.encode('utf-8'))
+    for line in sorted(exceptions):
+        key.update(f'{line}\n'.encode('utf-8'))
+    return key.hexdigest()
+
+
+def read_cache(path, exceptions):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if cache.get('key') != cache_key(exceptions):
+        return {}
+    return cache['volumes']
+
+
+def write_cache(path, exceptions, volumes):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'key': cache_key(exceptions), 'volumes': volumes}, f,
+                  ensure_ascii=False)
+    os.rename(path + '.tmp', path)  # atomic
+
+
 def read_exceptions():
     path = os.path.join(os.path.dirname(__file__), 'charset_exceptions.txt')
     result = set()
@@ -58,18 +207,35 @@ def read_exceptions():
     return result
 
 
-def print_stats(stats):
-    print('Date          Bad Records     %')
+def print_stats(stats, file=sys.stdout):
+    print('Date          Bad Records     %', file=file)
     num_records, num_bad_records = 0, 0
     for date, (bad, total) in sorted(stats.items()):
         bad_percent = float(bad) / total * 100.0
-        print('%s %6d %7d %5.1f' % (date, bad, total, bad_percent))
+        print('%s %6d %7d %5.1f' % (date, bad, total, bad_percent), file=file)
         num_bad_records += bad
         num_records += total
     bad_percent = float(num_bad_records) * 100.0 / num_records
-    print('Total      %6d %7d %5.1f' % (num_bad_records, num_records, bad_percent))
+    print('Total      %6d %7d %5.1f' % (num_bad_records, num_records, bad_percent),
+          file=file)
 
 
 if __name__ == '__main__':
-    stats = check()
-    print_stats(stats)
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--workers', type=int, default=0,
+        help='number of worker processes; default: one per CPU')
+    argparser.add_argument(
+        '--incremental', action='store_true',
+        help='only check volumes that changed since the last run')
+    argparser.add_argument(
+        '--cache', default=os.path.join('cache', 'check_charset.json'),
+        help='where --incremental keeps its results; default: %(default)s')
+    argparser.add_argument(
+        '--json', action='store_true',
+        help='report problems as JSON lines with file, line and column')
+    args = argparser.parse_args()
+    stats = check(workers=args.workers or os.cpu_count(),
+                  cache_path=args.cache if args.incremental else None,
+                  output='json' if args.json else 'text')
+    print_stats(stats, file=sys.stderr if args.json else sys.stdout)
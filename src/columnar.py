@@ -0,0 +1,116 @@
+# SPDX-License-Identifier: MIT
+#
+# Columnar output of the Bern address book in Apache Parquet format,
+# written alongside bern-address-book.csv. Needs pyarrow, which is only
+# imported when columnar output is actually requested.
+#
+# To check that a Parquet file has the same content as its CSV sibling:
+# python3 src/columnar.py bern-address-book.csv bern-address-book.parquet
+
+import argparse
+import csv
+
+
+COLUMNS = [
+    'Name', 'Surname', 'Date', 'Street', 'Housenumber', 'Postcode', 'City',
+    'Latitude', 'Longitude', 'Phone', 'PageID', 'Page',
+]
+
+
+def make_schema():
+    import pyarrow as pa
+    # Columns with few distinct values get dictionary-encoded.
+    dict_string = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('Name', pa.string()),
+        ('Surname', dict_string),
+        ('Date', dict_string),
+        ('Street', dict_string),
+        ('Housenumber', pa.string()),
+        ('Postcode', dict_string),
+        ('City', dict_string),
+        ('Latitude', pa.float64()),
+        ('Longitude', pa.float64()),
+        ('Phone', pa.string()),
+        ('PageID', pa.int64()),
+        ('Page', pa.string()),
+    ])
+
+
+class ParquetWriter(object):
+    # Writes Records into a Parquet file, with one row group per
+    # publication date. Readers can then skip all volumes but the
+    # ones they need, using the row group statistics on Date.
+    def __init__(self, path):
+        import pyarrow.parquet as pq
+        self.schema = make_schema()
+        self.writer = pq.ParquetWriter(
+            path, self.schema, compression='zstd', use_dictionary=True)
+        self.records = []
+
+    def write(self, rec):
+        if self.records and self.records[-1].Date != rec.Date:
+            self.flush()
+        self.records.append(rec)
+
+    def flush(self):
+        import pyarrow as pa
+        if not self.records:
+            return
+        columns = {c: [getattr(r, c) for r in self.records] for c in COLUMNS}
+        columns['PageID'] = [int(p) for p in columns['PageID']]
+        table = pa.Table.from_pydict(columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=len(self.records))
+        self.records = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_parquet_rows(path):
+    # Yields the rows of a Parquet file the way csv.writer would have
+    # formatted them, one row group at a time.
+    import pyarrow.parquet as pq
+    f = pq.ParquetFile(path)
+    for i in range(f.num_row_groups):
+        columns = f.read_row_group(i, columns=COLUMNS).to_pydict()
+        for values in zip(*(columns[c] for c in COLUMNS)):
+            # Missing coordinates are written as empty strings to CSV.
+            yield ['' if v is None else str(v) for v in values]
+
+
+def compare_csv(csv_path, parquet_path):
+    with open(csv_path, newline='') as stream:
+        reader = csv.reader(stream)
+        if next(reader) != COLUMNS:
+            raise ValueError(f'{csv_path}: unexpected header')
+        num_rows = 0
+        for csv_row, parquet_row in zip(reader, read_parquet_rows(parquet_path)):
+            num_rows += 1
+            if csv_row != parquet_row:
+                raise ValueError(f'row {num_rows} differs: '
+                                 f'{csv_row} versus {parquet_row}')
+        if next(reader, None) or num_rows != read_num_rows(parquet_path):
+            raise ValueError('CSV and Parquet differ in number of rows')
+    return num_rows
+
+
+def read_num_rows(parquet_path):
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(parquet_path).metadata.num_rows
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('csv')
+    argparser.add_argument('parquet')
+    args = argparser.parse_args()
+    num_rows = compare_csv(args.csv, args.parquet)
+    print(f'{args.parquet}: same {num_rows} rows as {args.csv}')
@@ -0,0 +1,153 @@
+# SPDX-License-Identifier: MIT
+#
+# On-disk index of the family names in Wikidata, for looking up the
+# Wikidata ID of a family name without loading the whole name dump.
+# The dump, cache/wikidata_family_names.csv.gz, gets converted once into
+# a sorted table, which is then memory-mapped and searched by bisection;
+# it is converted again when the dump changes. Nothing is read until the
+# first lookup, so tools that never look up a name pay nothing.
+#
+# Layout of the index file, with all integers as unsigned 64-bit
+# numbers in native byte order:
+#
+#   magic, dump size, dump modification time, number of names n,
+#   n offsets into the data, data
+#
+# where the data is a sequence of "name<TAB>id<NEWLINE>" lines, sorted
+# by the UTF-8 bytes of the name.
+
+import array
+import csv
+import gzip
+import io
+import mmap
+import os
+import struct
+
+
+MAGIC = b'WDFNIDX1'
+HEADER = struct.Struct('=8sQQQ')
+
+
+class FamilyNameIndex(object):
+    def __init__(self, cachedir):
+        self.dump_path = os.path.join(cachedir, 'wikidata_family_names.csv.gz')
+        self.path = os.path.join(cachedir, 'wikidata_family_names.idx')
+        self.file = self.map = None
+
+    def open(self):
+        if self.map is not None:
+            return
+        st = os.stat(self.dump_path)
+        if not self.is_current(st):
+            build_index(self.dump_path, self.path, st)
+        self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, _, n = HEADER.unpack_from(self.map)
+        self.num_names = n
+        self.view = memoryview(self.map)
+        self.offsets = self.view[HEADER.size:HEADER.size + 8 * n].cast('Q')
+        self.data_start = HEADER.size + 8 * n
+
+    def is_current(self, st):
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return False
+        if len(header) != HEADER.size:
+            return False
+        magic, size, mtime_ns, _ = HEADER.unpack(header)
+        return (magic, size, mtime_ns) == (MAGIC, st.st_size, st.st_mtime_ns)
+
+    def close(self):
+        if self.map is not None:
+            self.offsets.release()
+            self.view.release()
+            self.map.close()
+            self.file.close()
+            self.file = self.map = None
+
+    def __len__(self):
+        self.open()
+        return self.num_names
+
+    def entry(self, i):
+        start = self.data_start + self.offsets[i]
+        end = self.map.find(b'\n', start)
+        name, _, wikidata_id = self.map[start:end].partition(b'\t')
+        return name, wikidata_id
+
+    def search(self, key, lo=0, hi=None):
+        # Returns the position of the first name not less than key.
+        if hi is None:
+            hi = self.num_names
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, name, default=None):
+        self.open()
+        key = name.encode('utf-8')
+        i = self.search(key)
+        if i < self.num_names:
+            found, wikidata_id = self.entry(i)
+            if found == key:
+                return wikidata_id.decode('utf-8')
+        return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def lookup_many(self, names):
+        # Joins a batch of names against the index. With the names in
+        # sorted order, each search starts where the previous one ended
+        # and gallops ahead before bisecting, so that nearby names cost
+        # only a few comparisons.
+        self.open()
+        result = {}
+        lo, n = 0, self.num_names
+        for key in sorted({name.encode('utf-8') for name in names}):
+            step = 1
+            while lo + step < n and self.entry(lo + step)[0] < key:
+                step *= 2
+            lo = self.search(key, lo + step // 2, min(lo + step + 1, n))
+            if lo >= n:
+                break
+            found, wikidata_id = self.entry(lo)
+            if found == key:
+                result[key.decode('utf-8')] = wikidata_id.decode('utf-8')
+        return result
+
+
+def read_dump(path):
+    # Later rows replace earlier ones for the same name, as they
+    # did when the dump was read into a dict.
+    names = {}
+    with gzip.open(path, mode='rb') as bytestream:
+        with io.TextIOWrapper(bytestream, encoding='utf-8') as stream:
+            for row in csv.DictReader(stream):
+                name, wikidata_id = row['Name'], row['WikidataID']
+                # Tabs and newlines would break the line format.
+                if '\t' in name or '\n' in name:
+                    continue
+                names[name.encode('utf-8')] = wikidata_id.encode('utf-8')
+    return names
+
+
+def build_index(dump_path, path, st):
+    names = read_dump(dump_path)
+    offsets = array.array('Q')
+    data = io.BytesIO()
+    for name in sorted(names):
+        offsets.append(data.tell())
+        data.write(b'%s\t%s\n' % (name, names[name]))
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, len(offsets)))
+        offsets.tofile(f)
+        f.write(data.getbuffer())
+    os.rename(path + '.tmp', path)  # atomic
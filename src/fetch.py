@@ -4,17 +4,24 @@
 # Fetch address books of Bern (1861-1945) from www.e-rara.ch,
 # and auxiliary data (such as famiily names) from Wikidata.
 
+import argparse
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import csv
-import gzip
 import http
 import io
+import multiprocessing
 import requests
 import os
 import re
 import sqlite3
+import threading
+import time
 import xml.etree.ElementTree as etree
 import urllib
+import zlib
+
+from familynames import FamilyNameIndex
 
 
 Chapter = namedtuple('Chapter', ['id', 'title', 'date', 'year', 'volume', 'pages'])
@@ -25,6 +32,14 @@ ALTO_SPACE = '{http://www.loc.gov/standards/alto/ns-v3#}SP'
 ALTO_STRING = '{http://www.loc.gov/standards/alto/ns-v3#}String'
 ALTO_TEXTLINE = '{http://www.loc.gov/standards/alto/ns-v3#}TextLine'
 
+METS_DIV = '{http://www.loc.gov/METS/}div'
+METS_SMLINK = '{http://www.loc.gov/METS/}smLink'
+METS_STRUCTMAP = '{http://www.loc.gov/METS/}structMap'
+XLINK_FROM = '{http://www.w3.org/1999/xlink}from'
+XLINK_TO = '{http://www.w3.org/1999/xlink}to'
+
+ERARA_URL = 'https://www.e-rara.ch'
+
 
 def is_uppercase(c):
     return c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÜÉÈ'
@@ -33,37 +48,257 @@ def is_lowercase(c):
     return c in 'abcdefghijklmnopqrstuvwxyzäöüéè'
 
 
+def read_alto_lines(data):
+    # Streams the text lines of an ALTO page, without building a tree
+    # for the entire page. Elements get removed from their parent once
+    # they have been read, so memory stays flat no matter how large the
+    # page is; merely clearing them would leave their empty shells behind.
+    parents, in_line = [], False
+    for event, elem in etree.iterparse(io.BytesIO(data),
+                                       events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            in_line = in_line or elem.tag == ALTO_TEXTLINE
+            continue
+        parents.pop()
+        if elem.tag == ALTO_TEXTLINE:
+            tokens = []
+            for e in elem:
+                if e.tag == ALTO_STRING:
+                    tokens.append(e.attrib['CONTENT'])
+                elif e.tag == ALTO_SPACE:
+                    tokens.append(' ')
+            yield ''.join(tokens)
+            in_line = False
+        elif in_line:
+            continue  # still needed for the line it belongs to
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def read_mets_page_map(data):
+    # Returns the labels of the physical pages in a volume, and the
+    # physical pages linked from each logical structure (such as a
+    # chapter), in document order.
+    page_labels, chapter_pages = {}, {}
+    in_physical_map = False
+    for event, elem in etree.iterparse(io.BytesIO(data),
+                                       events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == METS_STRUCTMAP:
+                in_physical_map = (elem.attrib['TYPE'] == 'PHYSICAL')
+            elif elem.tag == METS_DIV and in_physical_map:
+                if elem.attrib['TYPE'] == 'page':
+                    page_id = int(elem.attrib['ID'].removeprefix('phys'))
+                    if label := elem.attrib.get('ORDERLABEL'):
+                        page_labels[page_id] = label
+            continue
+        if elem.tag == METS_SMLINK:
+            link_from_id = int(elem.attrib[XLINK_FROM].removeprefix('log'))
+            page_id = int(elem.attrib[XLINK_TO].removeprefix('phys'))
+            chapter_pages.setdefault(link_from_id, []).append(page_id)
+        elif elem.tag == METS_STRUCTMAP:
+            in_physical_map = False
+        elem.clear()
+    return page_labels, chapter_pages
+
+
+class Fetcher(object):
+    # Fetches URLs over a pooled HTTP session, from several threads at once.
+    # Requests to the same host are spaced out to stay within the rate
+    # limit, and failed requests are retried with exponential backoff.
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    RETRY_EXCEPTIONS = (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,  # truncated body
+        requests.exceptions.ContentDecodingError,
+    )
+
+    def __init__(self, max_workers=8, requests_per_second=5.0,
+                 max_retries=5, backoff=1.0):
+        self.max_workers = max_workers
+        self.min_interval = 1.0 / requests_per_second
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'BernAddressBookBot/1.0'
+        self.session.headers['From'] = 'sascha@brawer.ch'
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.next_request_time = {}  # host -> time.monotonic()
+
+    def get(self, url):
+        retry = 0
+        while True:
+            self.wait_for_turn(url)
+            try:
+                response = self.session.get(url, timeout=30)
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    # Reading the body can fail too, such as when the
+                    # connection drops before Content-Length bytes.
+                    return response.content
+                err = requests.HTTPError(
+                    f'{response.status_code} for {url}', response=response)
+            except self.RETRY_EXCEPTIONS as e:
+                err = e
+            retry += 1
+            if retry >= self.max_retries:
+                raise err
+            time.sleep(self.backoff * 2 ** (retry - 1))
+
+    def wait_for_turn(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request_time.get(host, now))
+            self.next_request_time[host] = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class PageStore(object):
+    # Single-file store for fetched documents, such as ALTO pages and
+    # volume METS files, keyed by strings like 'fulltext-1395917'.
+    # Documents are zlib-compressed individually, so single pages can
+    # be read without touching the rest of the store.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db, self.db_pid = None, None
+
+    def connect(self):
+        # SQLite connections must not be shared across a fork,
+        # so every process opens its own.
+        if self.db_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS documents ('
+                'key TEXT PRIMARY KEY, data BLOB NOT NULL)')
+            self.db_pid = os.getpid()
+        return self.db
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT 1 FROM documents WHERE key=?', (key,)).fetchone()
+        return row is not None
+
+    def keys(self):
+        with self.lock:
+            rows = self.connect().execute('SELECT key FROM documents')
+            return {key for (key,) in rows}
+
+    def get(self, key):
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT data FROM documents WHERE key=?', (key,)).fetchone()
+        return zlib.decompress(row[0]) if row else None
+
+    INSERT = 'INSERT OR REPLACE INTO documents (key, data) VALUES (?, ?)'
+
+    def put(self, key, data):
+        # Level 9 is several times slower than the default level,
+        # but hardly makes XML any smaller.
+        compressed = zlib.compress(data)
+        with self.lock:
+            self.connect().execute(self.INSERT, (key, compressed))
+
+    def migrate_loose_files(self, dirpath, batch_size=1000):
+        # One-shot migration from the cache layout of earlier versions,
+        # which kept every fetched document in a separate XML file.
+        # Each batch is a single transaction, which is much faster than
+        # committing every file, and loose files only get removed once
+        # their batch has been committed. An interrupted migration thus
+        # never loses a document, and resumes on the next run.
+        filenames = sorted(
+            f for f in os.listdir(dirpath) if f.endswith('.xml') and
+            (f.startswith('fulltext-') or f.startswith('mets-')))
+        for start in range(0, len(filenames), batch_size):
+            paths = [os.path.join(dirpath, f)
+                     for f in filenames[start:start + batch_size]]
+            with self.lock:
+                db = self.connect()
+                db.execute('BEGIN')
+                try:
+                    for path in paths:
+                        key = os.path.basename(path).removesuffix('.xml')
+                        with open(path, 'rb') as f:
+                            db.execute(self.INSERT,
+                                       (key, zlib.compress(f.read())))
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+            for path in paths:
+                os.remove(path)
+        return len(filenames)
+
+
 class Extractor(object):
-    def __init__(self, cachedir):
+    def __init__(self, cachedir, base_url=ERARA_URL, fetcher=None):
         self.cachedir = cachedir
+        self.base_url = base_url
+        self.fetcher = fetcher or Fetcher()
+        self.store = PageStore(os.path.join(cachedir, 'pages.sqlite'))
+        self.volume_page_maps = {}
         self.ads_denylist = self.read_ads_denylist()
         self.families = self.read_families()
-        self.wikidata_family_names = self.read_wikidata_family_names()
+        # Only opened when suggest_families() looks up a name.
+        self.wikidata_family_names = FamilyNameIndex(cachedir)
 
-    def run(self):
+    def run(self, workers=1):
         if not os.path.exists(self.cachedir):
             os.mkdir(self.cachedir)
-        #self.process_proofread()
-        for chapter in self.find_chapters():
-            if chapter.date[:4] in ['1944', '1861']:
-                continue
-            with open(f'proofread/{chapter.date}.txt', 'w') as out:
-                for page in chapter.pages:
-                    self.process_page(chapter, page, out)
+        if n := self.store.migrate_loose_files(self.cachedir):
+            print(f'migrated {n} cached files into {self.store.path}')
+        self.prefetch_volumes(self.find_volumes())
+        chapters = [c for c in self.find_chapters()
+                    if c.date[:4] not in ['1944', '1861']]
+        self.prefetch_pages([p.id for c in chapters for p in c.pages])
+        self.extract_chapters(chapters, workers)
+
+    def extract_chapters(self, chapters, workers=1):
+        if workers == 1:
+            for chapter in chapters:
+                with open(f'proofread/{chapter.date}.txt', 'w') as out:
+                    for page in chapter.pages:
+                        self.process_page(chapter, page, out)
+            return
+        # Once all pages are in the page store, extraction is bound by CPU,
+        # so pages get extracted in a process pool. Pool.imap returns the
+        # pages in the order of its input, so every proofread file is
+        # written exactly like in a serial run.
+        jobs = [(chapter, page) for chapter in chapters
+                for page in chapter.pages]
+        with multiprocessing.Pool(workers, initializer=init_worker,
+                                  initargs=(self.cachedir, self.base_url)) as pool:
+            out, out_chapter = None, None
+            for (chapter, page), text in zip(
+                    jobs, pool.imap(process_page_job, jobs, chunksize=4)):
+                if chapter is not out_chapter:
+                    if out:
+                        out.close()
+                    out = open(f'proofread/{chapter.date}.txt', 'w')
+                    out_chapter = chapter
+                out.write(text)
+            if out:
+                out.close()
 
     def process_page(self, chapter, page, out):
-        et = etree.fromstring(self.fetch_page_xml(page.id))
+        data = self.fetch_page_xml(page.id)
         out.write(f'# Date: {chapter.date} Page: {page.id}/{page.label}\n')
         lines = []
         cur_line = ''
-        for line in et.findall(f'.//{ALTO_TEXTLINE}'):
-            tokens = []
-            for e in line:
-                if e.tag == ALTO_STRING:
-                    tokens.append(e.attrib['CONTENT'])
-                elif e.tag == ALTO_SPACE:
-                    tokens.append(' ')
-            this_line = ''.join(tokens)
+        for this_line in read_alto_lines(data):
             this_line = this_line.replace('[', ' [')
             if this_line.startswith('■—') or this_line.startswith('*-'):
                 this_line = this_line[1:]
@@ -113,25 +348,12 @@ class Extractor(object):
         return chapters
 
     def find_chapter_pages(self, volume_id, chapter_id):
-        et = etree.fromstring(self.fetch_volume_mets(volume_id))
-        page_labels = {}
-        for smap in et.iter('{http://www.loc.gov/METS/}structMap'):
-            if smap.attrib['TYPE'] == 'PHYSICAL':
-                for div in smap.iter('{http://www.loc.gov/METS/}div'):
-                    if div.attrib['TYPE'] == 'page':
-                        page_id = int(div.attrib['ID'].removeprefix('phys'))
-                        if label := div.attrib.get('ORDERLABEL'):
-                            page_labels[page_id] = label
+        page_labels, chapter_pages = self.read_volume_page_map(volume_id)
         pages = []
-        for link in et.iter('{http://www.loc.gov/METS/}smLink'):
-            link_from  = link.attrib['{http://www.w3.org/1999/xlink}from']
-            link_from_id = int(link_from.removeprefix("log"))
-            if link_from_id == chapter_id:
-                link_to = link.attrib['{http://www.w3.org/1999/xlink}to']
-                page_id = int(link_to.removeprefix('phys'))
-                if page_id not in self.ads_denylist:
-                    page = Page(id=page_id, label=page_labels.get(page_id))
-                    pages.append(page)
+        for page_id in chapter_pages.get(chapter_id, []):
+            if page_id not in self.ads_denylist:
+                page = Page(id=page_id, label=page_labels.get(page_id))
+                pages.append(page)
 
         # If the first page has no number, synthesize it: '[123]'.
         if not pages[0].label:
@@ -140,50 +362,100 @@ class Extractor(object):
 
         return pages
 
+    def read_volume_page_map(self, volume_id):
+        # Several chapters can be in the same volume, but there is
+        # no need to parse the same multi-megabyte METS file again.
+        if volume_id not in self.volume_page_maps:
+            mets = self.fetch_volume_mets(volume_id)
+            self.volume_page_maps[volume_id] = read_mets_page_map(mets)
+        return self.volume_page_maps[volume_id]
+
+    def find_volumes(self):
+        path = os.path.join(os.path.dirname(__file__), 'chapters.csv')
+        with open(path) as csvfile:
+            dialect = csv.Sniffer().sniff(csvfile.read(1024))
+            csvfile.seek(0)
+            volumes = {int(row['VolumeID'])
+                       for row in csv.DictReader(csvfile, dialect=dialect)}
+        return sorted(volumes)
+
+    def volume_mets_url(self, volume):
+        return (f'{self.base_url}/oai?verb=GetRecord&metadataPrefix=mets' +
+                f'&identifier={volume}')
+
+    def page_xml_url(self, page_id):
+        return f'{self.base_url}/bes_1/download/fulltext/alto3/{page_id}'
+
     def fetch_volume_mets(self, volume):
-        filepath = f"{self.cachedir}/mets-{volume}.xml"
-        if not os.path.exists(filepath):
-            req = requests.get(
-                "https://www.e-rara.ch/oai?verb=GetRecord&metadataPrefix=mets" +
-                f"&identifier={volume}")
-            with open(filepath, 'wb') as f:
-                f.write(req.content)
-        with open(filepath, 'rb') as f:
-            return f.read()
+        return self.fetch_document(f'mets-{volume}',
+                                   self.volume_mets_url(volume))
 
     def fetch_page_xml(self, page_id):
-        filepath = f"{self.cachedir}/fulltext-{page_id}.xml"
-        if not os.path.exists(filepath):
-            req = requests.get(f'https://www.e-rara.ch/bes_1/download/fulltext/alto3/{page_id}')
-            with open(filepath+'.tmp', 'w') as f:
-                f.write(req.text)
-            os.rename(filepath+'.tmp', filepath)  # atomic
-        with open(filepath, 'r') as f:
-            return f.read()
-
-    def process_proofread(self):
+        return self.fetch_document(f'fulltext-{page_id}',
+                                   self.page_xml_url(page_id))
+
+    def fetch_document(self, key, url):
+        data = self.store.get(key)
+        if data is None:
+            data = self.fetcher.get(url)
+            self.store.put(key, data)
+        return data
+
+    def prefetch_volumes(self, volumes):
+        self.prefetch([(f'mets-{v}', self.volume_mets_url(v))
+                       for v in volumes])
+
+    def prefetch_pages(self, page_ids):
+        self.prefetch([(f'fulltext-{p}', self.page_xml_url(p))
+                       for p in page_ids])
+
+    def prefetch(self, jobs):
+        # Fetches (key, url) jobs concurrently into the page store.
+        # Since every document is stored as soon as it has been fetched,
+        # an interrupted run resumes where it stopped.
+        if not os.path.exists(self.cachedir):
+            os.mkdir(self.cachedir)
+        done = self.store.keys()
+        todo = [(key, url) for key, url in jobs if key not in done]
+        if not todo:
+            return
+        num_done, failures = 0, []
+        with ThreadPoolExecutor(self.fetcher.max_workers) as executor:
+            futures = [(key, url, executor.submit(self.fetch_document, key, url))
+                       for key, url in todo]
+            for key, url, future in futures:
+                if err := future.exception():
+                    failures.append(key)
+                    print(f'failed to fetch {url}: {err}')
+                num_done += 1
+                if num_done % 500 == 0:
+                    print(f'fetched {num_done} of {len(todo)} documents')
+        if failures:
+            raise RuntimeError(f'failed to fetch {len(failures)} documents, '
+                               f'first failure: {failures[0]}')
+
+    def suggest_families(self):
+        # Family names in the proofread volumes that are missing in
+        # families.txt but known to Wikidata, in order of appearance.
         dirpath = os.path.join(os.path.dirname(__file__), '..', 'proofread')
+        names = {}
         for date in sorted(os.listdir(dirpath)):
             path = os.path.join(dirpath, date)
-            for line in open(path):
-                if line[0] == '#':
-                    pass
-                elif line[0] == '—':
-                    pass
-                else:
-                    name = self.get_family_name(line)
-                    if name not in self.families:
-                        wikidata_id = self.wikidata_family_names.get(name)
-                        if wikidata_id and ';' not in name:
-                            print('%s;%s' % (name, wikidata_id))
+            with open(path) as stream:
+                for line in stream:
+                    if line[0] not in '#—' and not line.isspace():
+                        names[self.get_family_name(line)] = None
+        names = [n for n in names if n not in self.families and ';' not in n]
+        found = self.wikidata_family_names.lookup_many(names)
+        return [(name, found[name]) for name in names if name in found]
 
     def get_family_name(self, line):
         if line.startswith('v.'):
-            name = 'von ' + line[2:].split()[0]
+            name = 'von ' + line[2:].split(None, 1)[0]
         elif line.startswith('de '):
-            name = 'de ' + line[2:].split()[0]
+            name = 'de ' + line[2:].split(None, 1)[0]
         else:
-            name = line.split()[0]
+            name = line.split(None, 1)[0]
         return name.removesuffix(',')
 
     def read_ads_denylist(self):
@@ -204,15 +476,21 @@ class Extractor(object):
                 result[name] = wikidata_id
         return result
 
-    def read_wikidata_family_names(self):
-        result = {}
-        filepath = os.path.join(self.cachedir, 'wikidata_family_names.csv.gz')
-        with gzip.open(filepath, mode='rb') as bytestream:
-            with io.TextIOWrapper(bytestream, encoding='utf-8') as stream:
-                for row in csv.DictReader(stream):
-                    name, id = row['Name'], row['WikidataID']
-                    result[name] = id
-        return result
+
+# Set in each worker process of the pool used by extract_chapters().
+worker_extractor = None
+
+
+def init_worker(cachedir, base_url):
+    global worker_extractor
+    worker_extractor = Extractor(cachedir, base_url=base_url)
+
+
+def process_page_job(job):
+    chapter, page = job
+    out = io.StringIO()
+    worker_extractor.process_page(chapter, page, out)
+    return out.getvalue()
 
 
 def make_request(url):
@@ -252,7 +530,21 @@ def fetch_wikidata_family_names(cachedir):
 
 
 if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of worker processes for extracting pages; '
+             '0 for one per CPU core')
+    argparser.add_argument(
+        '--suggest-families', action='store_true',
+        help='instead of fetching, print family names from the proofread '
+             'volumes that are in Wikidata but not in families.txt')
+    args = argparser.parse_args()
     cachedir = "cache"
-    fetch_wikidata_family_names(cachedir)
     ex = Extractor(cachedir)
-    ex.run()
+    if args.suggest_families:
+        fetch_wikidata_family_names(cachedir)
+        for name, wikidata_id in ex.suggest_families():
+            print('%s;%s' % (name, wikidata_id))
+    else:
+        ex.run(workers=args.workers or os.cpu_count())
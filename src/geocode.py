@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: MIT
+#
+# Batch geocoding of an address book that has already been parsed.
+# Postcode, City, Latitude and Longitude get filled in from the official
+# address register, without parsing the proofread text again; this is
+# useful after Street or Housenumber were corrected by hand, or after
+# adding alternate street names. Records whose address was not found
+# while parsing only make it into the address book with --keep-unresolved,
+# so that is how to produce the input. For example:
+#
+#   python3 src/process.py --keep-unresolved \
+#       --output bern-address-book-unresolved.csv
+#   python3 src/geocode.py bern-address-book-unresolved.csv \
+#       --output geocoded.csv --aliases street-aliases.csv \
+#       --stats geocoding.stats.json
+#
+# The optional aliases file has the columns Alias and Street, mapping
+# an old or alternate street name to the name in the address register.
+# Records whose address cannot be resolved are written unchanged.
+
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+
+from columnar import COLUMNS
+from process import Processor
+
+
+STREET, HOUSENUMBER, POSTCODE, CITY, LATITUDE, LONGITUDE = (
+    COLUMNS.index(c) for c in ('Street', 'Housenumber', 'Postcode', 'City',
+                               'Latitude', 'Longitude'))
+
+
+class Geocoder(object):
+    def __init__(self, register, aliases=None):
+        self.register = register
+        self.aliases = aliases or {}
+
+    def resolve(self, keys):
+        # Maps each distinct (street, housenumber) to the values of the
+        # address columns, or to None. A volume has many records for the
+        # same address, so every address gets looked up once per batch.
+        reg = self.register
+        result = {}
+        for street, housenumber in keys:
+            name, row = street, reg.find_row(street, housenumber)
+            if row is None and (alias := self.aliases.get(street)):
+                name, row = alias, reg.find_row(alias, housenumber)
+            if row is None:
+                values = None
+            else:
+                # As formatted by csv.writer in process.py.
+                values = [name, reg.postcodes[reg.postcode_ids[row]],
+                          reg.cities[reg.city_ids[row]],
+                          str(reg.lats[row]), str(reg.lngs[row])]
+            result[(street, housenumber)] = values
+        return result
+
+    def enrich(self, records):
+        # Fills in the address columns of a batch of records, given as
+        # lists in the order of COLUMNS, and returns coverage stats.
+        start = time.perf_counter()
+        keys = {(rec[STREET], rec[HOUSENUMBER]) for rec in records}
+        resolved = self.resolve(keys)
+        stats = {'records': len(records), 'addresses': len(keys),
+                 'resolved': 0, 'unresolved': 0, 'changed': 0, 'filled': 0}
+        for rec in records:
+            values = resolved[(rec[STREET], rec[HOUSENUMBER])]
+            if values is None:
+                stats['unresolved'] += 1
+                continue
+            stats['resolved'] += 1
+            old = [rec[STREET], rec[POSTCODE], rec[CITY],
+                   rec[LATITUDE], rec[LONGITUDE]]
+            if values != old:
+                stats['changed'] += 1
+                # Records that had no coordinates before.
+                if not rec[LATITUDE]:
+                    stats['filled'] += 1
+                (rec[STREET], rec[POSTCODE], rec[CITY],
+                 rec[LATITUDE], rec[LONGITUDE]) = values
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+
+def read_aliases(path):
+    with open(path, newline='') as stream:
+        return {row['Alias']: row['Street'] for row in csv.DictReader(stream)}
+
+
+def enrich_csv(geocoder, in_stream, out_stream):
+    # Records of the same volume are adjacent in the address book,
+    # so each volume gets enriched as one batch.
+    reader = csv.reader(in_stream)
+    header = next(reader)
+    if header != COLUMNS:
+        raise ValueError(f'unexpected header: {header}')
+    writer = csv.writer(out_stream)
+    writer.writerow(COLUMNS)
+    date_col = COLUMNS.index('Date')
+    volume_stats = {}
+    for date, batch in itertools.groupby(reader, key=lambda r: r[date_col]):
+        records = list(batch)
+        stats = geocoder.enrich(records)
+        if date in volume_stats:
+            for name, value in stats.items():
+                volume_stats[date][name] += value
+        else:
+            volume_stats[date] = stats
+        writer.writerows(records)
+    return volume_stats
+
+
+def print_stats(volume_stats, file):
+    print('Date        Records  Resolved      %  Changed   Filled', file=file)
+    totals = {'records': 0, 'resolved': 0, 'changed': 0, 'filled': 0}
+    for date, stats in sorted(volume_stats.items()):
+        print('%s %8d %9d %6.1f %8d %8d' % (
+            date, stats['records'], stats['resolved'],
+            stats['resolved'] * 100.0 / max(stats['records'], 1),
+            stats['changed'], stats['filled']), file=file)
+        for name in totals:
+            totals[name] += stats[name]
+    print('Total      %8d %9d %6.1f %8d %8d' % (
+        totals['records'], totals['resolved'],
+        totals['resolved'] * 100.0 / max(totals['records'], 1),
+        totals['changed'], totals['filled']), file=file)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('input', help='address book in CSV format')
+    argparser.add_argument('--output', required=True,
+                           help='path for the geocoded CSV, or - for stdout')
+    argparser.add_argument('--aliases', metavar='PATH',
+                           help='CSV file with alternate street names')
+    argparser.add_argument('--stats', metavar='PATH',
+                           help='write per-volume coverage stats as JSON')
+    args = argparser.parse_args()
+    p = Processor(cachedir='cache')
+    aliases = read_aliases(args.aliases) if args.aliases else None
+    geocoder = Geocoder(p.addresses, aliases)
+    with open(args.input, newline='') as in_stream:
+        if args.output == '-':
+            volume_stats = enrich_csv(geocoder, in_stream, sys.stdout)
+        else:
+            with open(args.output, 'w') as out_stream:
+                volume_stats = enrich_csv(geocoder, in_stream, out_stream)
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(volume_stats, f, indent=2, sort_keys=True)
+    print_stats(volume_stats, file=sys.stderr)
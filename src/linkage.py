@@ -0,0 +1,347 @@
+# SPDX-License-Identifier: MIT
+#
+# Links the entries of the address book across editions, assigning
+# every record a person ID and a household ID. For example:
+#
+#   python3 src/linkage.py --output bern-address-book-linked.csv
+#   python3 src/linkage.py --scaling
+#
+# Comparing all pairs of records would take quadratic time, so records
+# are first grouped into blocks that share a key, such as the normalized
+# family name with the initial of the given name and the street. Within
+# each block, records are sorted by date and every record is compared
+# only with a window of its successors. A record is in several blocks,
+# one per key, so people who moved or whose given name got abbreviated
+# differently can still be linked. Blocks are scored in parallel; the
+# resulting links are then clustered with union-find, strongest first,
+# never merging two clusters that have an edition in common.
+
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from columnar import COLUMNS
+from process import ACCEPTED_AFFIXES
+
+
+# Number of successors that each record gets compared with in its
+# block, after sorting the block by date.
+WINDOW = 20
+
+# Minimum score for two records to be linked as the same person.
+LINK_THRESHOLD = 0.6
+
+NAME, SURNAME, DATE, STREET, HOUSENUMBER, PHONE, PAGE_ID = (
+    COLUMNS.index(c) for c in ('Name', 'Surname', 'Date', 'Street',
+                               'Housenumber', 'Phone', 'PageID'))
+
+
+def normalize_surname(surname):
+    return ''.join(c for c in surname.casefold() if c.isalpha())
+
+
+def normalize_given_names(name):
+    # "Wwe. Joh. Friedr." becomes ("joh", "friedr").
+    words = [w for w in name.split() if w not in ACCEPTED_AFFIXES]
+    return tuple(w.rstrip('.').casefold() for w in words if w.rstrip('.'))
+
+
+def make_features(rec):
+    given = normalize_given_names(rec[NAME])
+    return (normalize_surname(rec[SURNAME]), given,
+            given[0][0] if given else '', rec[STREET], rec[HOUSENUMBER],
+            int(rec[DATE][:4]), rec[DATE], rec[PHONE])
+
+
+def blocking_keys(features):
+    surname, given, initial, street, _, _, _, _ = features
+    if not surname:
+        return []
+    # Prefixing each key with its kind keeps the key spaces apart.
+    return [('street', surname, initial, street),
+            ('given', surname, given)]
+
+
+def make_blocks(features):
+    blocks = {}
+    for i, f in enumerate(features):
+        for key in blocking_keys(f):
+            blocks.setdefault(key, []).append(i)
+    # A record alone in its block has nothing to be compared with.
+    return [b for b in blocks.values() if len(b) > 1]
+
+
+def given_name_score(a, b):
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    # "joh" is an abbreviation of "johann"; the same holds word by word.
+    if len(a) == len(b) and all(x.startswith(y) or y.startswith(x)
+                                for x, y in zip(a, b)):
+        return 0.8
+    if a[0][0] == b[0][0]:
+        return 0.3
+    return 0.0
+
+
+def score(a, b):
+    _, given_a, _, street_a, number_a, year_a, date_a, phone_a = a
+    _, given_b, _, street_b, number_b, year_b, date_b, phone_b = b
+    # Within one edition, two entries are two different people.
+    if date_a == date_b:
+        return 0.0
+    s = 0.5 * given_name_score(given_a, given_b)
+    if street_a == street_b:
+        s += 0.25
+        if number_a == number_b:
+            s += 0.15
+    if phone_a and phone_a == phone_b:
+        s += 0.3
+    # Links over many years need more evidence.
+    s -= 0.01 * max(abs(year_a - year_b) - 10, 0)
+    return s
+
+
+def score_blocks(blocks, features, window=WINDOW):
+    links, num_pairs = [], 0
+    for block in blocks:
+        block = sorted(block, key=lambda i: features[i][6])
+        for pos, i in enumerate(block):
+            fi = features[i]
+            for j in block[pos + 1:pos + 1 + window]:
+                num_pairs += 1
+                if (s := score(fi, features[j])) >= LINK_THRESHOLD:
+                    links.append((s, i, j))
+    return links, num_pairs
+
+
+worker_features = None
+
+
+def init_worker(features):
+    global worker_features
+    worker_features = features
+
+
+def score_blocks_job(blocks):
+    return score_blocks(blocks, worker_features)
+
+
+def split_blocks(blocks, num_chunks):
+    # Deals out blocks from the largest to the smallest, always to the
+    # chunk with the least work so far, so that workers finish together.
+    chunks = [[] for _ in range(num_chunks)]
+    work = [0] * num_chunks
+    for block in sorted(blocks, key=len, reverse=True):
+        c = work.index(min(work))
+        chunks[c].append(block)
+        work[c] += len(block) * min(len(block), WINDOW)
+    return [c for c in chunks if c]
+
+
+class UnionFind(object):
+    def __init__(self, n, dates=None):
+        self.parent = list(range(n))
+        # If dates are given, one per element, clusters that have a date
+        # in common never get merged. Sets of dates are only kept for the
+        # roots of clusters with more than one element.
+        self.dates = dates
+        self.cluster_dates = {}
+
+    def find(self, i):
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:  # path compression
+            parent[i], i = root, parent[i]
+        return root
+
+    def union(self, i, j):
+        # Returns False if the clusters of i and j may not be merged.
+        ri, rj = self.find(i), self.find(j)
+        if ri == rj:
+            return True
+        # The smaller index becomes the root, which keeps
+        # the clustering independent of the order of links.
+        if rj < ri:
+            ri, rj = rj, ri
+        if self.dates is not None:
+            di = self.cluster_dates.pop(ri, None) or {self.dates[ri]}
+            dj = self.cluster_dates.pop(rj, None) or {self.dates[rj]}
+            if not di.isdisjoint(dj):
+                self.cluster_dates[ri], self.cluster_dates[rj] = di, dj
+                return False
+            di |= dj
+            self.cluster_dates[ri] = di
+        self.parent[rj] = ri
+        return True
+
+
+def stable_ids(records, uf, prefix):
+    # Names each cluster after its first record, which stays the same
+    # when unrelated volumes get added or re-parsed.
+    ids = {}
+    num_seen = {}  # key -> number of clusters named after it so far
+    result = []
+    for i, rec in enumerate(records):
+        root = uf.find(i)
+        if root not in ids:
+            first = records[root]
+            key = '\t'.join((first[DATE], first[PAGE_ID], first[SURNAME],
+                             first[NAME], first[STREET], first[HOUSENUMBER]))
+            # An entry printed twice on the same page would otherwise
+            # give two clusters the same name.
+            n = num_seen[key] = num_seen.get(key, 0) + 1
+            if n > 1:
+                key = f'{key}\t{n}'
+            digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+            ids[root] = prefix + digest[:12]
+        result.append(ids[root])
+    return result
+
+
+def link(records, workers=1):
+    report = {'records': len(records)}
+    timings = {}
+
+    start = time.perf_counter()
+    features = [make_features(rec) for rec in records]
+    blocks = make_blocks(features)
+    timings['blocking'] = time.perf_counter() - start
+    report['blocks'] = len(blocks)
+    report['largest_block'] = max((len(b) for b in blocks), default=0)
+
+    start = time.perf_counter()
+    if workers == 1 or len(blocks) < 2:
+        results = [score_blocks(blocks, features)]
+    else:
+        chunks = split_blocks(blocks, workers * 4)
+        with multiprocessing.Pool(workers, initializer=init_worker,
+                                  initargs=(features,)) as pool:
+            results = pool.map(score_blocks_job, chunks)
+    timings['scoring'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Within one edition, two entries are two different people, which
+    # must also hold for chains of links. The strongest links get merged
+    # first, so a weak link cannot block a better one.
+    n = len(records)
+    persons = UnionFind(n, [f[6] for f in features])
+    # Scores take few distinct values, so links get grouped by score.
+    # Each pair is encoded as one int, which is quick to deduplicate
+    # (pairs that share several blocks get scored more than once)
+    # and to sort; sorting makes the result the same however the
+    # blocks were dealt out to the workers.
+    by_score = {}
+    report['candidate_pairs'] = 0
+    for links, num_pairs in results:
+        report['candidate_pairs'] += num_pairs
+        for s, i, j in links:
+            by_score.setdefault(s, set()).add(i * n + j)
+    report['links'] = report['refused_links'] = 0
+    for s in sorted(by_score, reverse=True):
+        for pair in sorted(by_score[s]):
+            report['links'] += 1
+            if not persons.union(*divmod(pair, n)):
+                report['refused_links'] += 1
+    # A household is everyone living at the same address under the
+    # same family name in one edition, followed across editions
+    # through the people who belong to it.
+    households = UnionFind(len(records))
+    for i in range(len(records)):
+        households.union(i, persons.find(i))
+    first_at_address = {}
+    for i, f in enumerate(features):
+        key = (f[6], f[0], f[3], f[4])
+        households.union(first_at_address.setdefault(key, i), i)
+    person_ids = stable_ids(records, persons, 'P')
+    household_ids = stable_ids(records, households, 'H')
+    timings['clustering'] = time.perf_counter() - start
+
+    report['persons'] = len(set(person_ids))
+    report['households'] = len(set(household_ids))
+    report['seconds'] = timings
+    return person_ids, household_ids, report
+
+
+def read_records(path):
+    with open(path, newline='') as stream:
+        reader = csv.reader(stream)
+        if next(reader) != COLUMNS:
+            raise ValueError(f'{path}: unexpected header')
+        return list(reader)
+
+
+def print_report(report, file):
+    for name in ('records', 'blocks', 'largest_block', 'candidate_pairs',
+                 'links', 'refused_links', 'persons', 'households'):
+        print(f'{name.replace("_", " ")}: {report[name]}', file=file)
+    for stage, seconds in report['seconds'].items():
+        print(f'{stage}: {seconds:.2f}s', file=file)
+
+
+def measure_scaling(records, workers, file):
+    # Links growing prefixes of the address book, to check that
+    # candidate pairs and time grow linearly with the number of records.
+    # With two blocking keys, a record is compared with at most
+    # 2 * WINDOW others, however many editions there are.
+    dates = sorted({rec[DATE] for rec in records})
+    print('Volumes  Records  Candidate pairs  Pairs/record  Seconds  '
+          'µs/record', file=file)
+    results = []
+    for fraction in (0.125, 0.25, 0.5, 1.0):
+        selected = set(dates[:max(1, int(len(dates) * fraction))])
+        subset = [rec for rec in records if rec[DATE] in selected]
+        _, _, report = link(subset, workers)
+        seconds = sum(report['seconds'].values())
+        print('%7d %8d %16d %13.1f %8.2f %10.1f' % (
+            len(selected), len(subset), report['candidate_pairs'],
+            report['candidate_pairs'] / len(subset), seconds,
+            seconds * 1e6 / len(subset)), file=file)
+        results.append({'volumes': len(selected), 'records': len(subset),
+                        'candidate_pairs': report['candidate_pairs'],
+                        'seconds': seconds})
+    return results
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--input', default='bern-address-book.csv',
+        help='address book in CSV format; default: %(default)s')
+    argparser.add_argument(
+        '--output', metavar='PATH',
+        help='write the address book with PersonID and HouseholdID columns')
+    argparser.add_argument(
+        '--report', metavar='PATH',
+        help='write pair counts and timings as JSON')
+    argparser.add_argument(
+        '--workers', type=int, default=0,
+        help='number of worker processes; default: one per CPU')
+    argparser.add_argument(
+        '--scaling', action='store_true',
+        help='measure how linkage scales with the size of the address book')
+    args = argparser.parse_args()
+    workers = args.workers or os.cpu_count()
+    records = read_records(args.input)
+    if args.scaling:
+        report = {'scaling': measure_scaling(records, workers, sys.stdout)}
+    else:
+        person_ids, household_ids, report = link(records, workers)
+        print_report(report, sys.stdout)
+        if args.output:
+            with open(args.output, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(COLUMNS + ['PersonID', 'HouseholdID'])
+                for rec, pid, hid in zip(records, person_ids, household_ids):
+                    writer.writerow(rec + [pid, hid])
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,209 @@
+# SPDX-License-Identifier: MIT
+#
+# Index from page IDs to their place in the proofread volumes, so that
+# tools can read a single page without reading its whole volume. Each
+# page is the block of lines that starts with its "# Date: ... Page: ..."
+# header. The index lives in the cache directory and gets updated for
+# those volumes whose size or modification time has changed.
+#
+# To show where a page is, and to print its proofread text:
+#
+#   python3 src/pageindex.py 1395917
+#   python3 src/pageindex.py --text 1395917
+
+import argparse
+from collections import namedtuple
+import mmap
+import os
+import pickle
+import re
+import sys
+
+
+# Bump whenever the layout of the index changes,
+# so that stale indexes in the cache directory get rebuilt.
+PAGE_INDEX_VERSION = 1
+
+PAGE_HEADER_RE = re.compile(
+    rb'^# Date: (\d{4}-\d\d-\d\d) Page: (\d+)/([\[\]\d]+)\s*$')
+
+
+# Start and End are byte offsets into the volume at Path. FirstLine
+# is the line number of the page header, LastLine that of the last
+# line of the page; both count from 1.
+PageLocation = namedtuple('PageLocation', [
+    'PageID', 'Date', 'Label', 'Path', 'Start', 'End', 'FirstLine', 'LastLine',
+])
+
+
+class PageIndex(object):
+    def __init__(self, path, volume_paths):
+        self.path = path
+        self.volume_paths = {os.path.basename(p): p for p in volume_paths}
+        self.volumes = {}  # filename -> {'stamp': ..., 'pages': [...]}
+        self.locations = {}  # page id -> (filename, position in pages)
+        self.maps = {}  # volume path -> (file, mmap)
+
+    def update(self):
+        # Re-scans the volumes that changed since the index was last
+        # saved, and returns their number.
+        saved = self.read()
+        volumes, num_scanned = {}, 0
+        for filename, path in sorted(self.volume_paths.items()):
+            stamp = volume_stamp(path)
+            if (volume := saved.get(filename)) and volume['stamp'] == stamp:
+                volumes[filename] = volume
+                continue
+            self.unmap(path)
+            volumes[filename] = {'stamp': stamp, 'pages': scan_volume(path)}
+            num_scanned += 1
+        self.volumes = volumes
+        self.locations = {}
+        for filename, volume in volumes.items():
+            for i, page in enumerate(volume['pages']):
+                self.locations[page[0]] = (filename, i)
+        if num_scanned or len(volumes) != len(saved):
+            self.write()
+        return num_scanned
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'rb') as f:
+            try:
+                index = pickle.load(f)
+            except (pickle.UnpicklingError, AttributeError, EOFError):
+                return {}
+        if index.get('version') != PAGE_INDEX_VERSION:
+            return {}
+        return index['volumes']
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Plain tuples, so the index can be unpickled no matter
+        # whether this file runs as a script or gets imported.
+        index = {'version': PAGE_INDEX_VERSION, 'volumes': self.volumes}
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(self.path + '.tmp', self.path)  # atomic
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, page_id):
+        return page_id in self.locations
+
+    def locate(self, page_id):
+        filename, i = self.locations[page_id]
+        page_id, date, label, start, first_line, end, last_line = \
+            self.volumes[filename]['pages'][i]
+        return PageLocation(page_id, date, label, self.volume_paths[filename],
+                            start, end, first_line, last_line)
+
+    def page_ids(self):
+        # All page IDs, in the order of the volumes and of the pages
+        # inside each volume.
+        for filename, volume in self.volumes.items():
+            for page in volume['pages']:
+                yield page[0]
+
+    def volume_page_ids(self, path):
+        volume = self.volumes.get(os.path.basename(path))
+        return [page[0] for page in volume['pages']] if volume else []
+
+    def page_range(self, first, last):
+        # Page IDs from first to last, both included, in index order.
+        # Page IDs grow within a volume, but not always across volumes.
+        for page_id in (first, last):
+            if page_id not in self:
+                raise KeyError(f'unknown page: {page_id}')
+        ids = list(self.page_ids())
+        lo, hi = ids.index(first), ids.index(last)
+        if lo > hi:
+            raise ValueError(f'page {first} comes after page {last}')
+        return ids[lo:hi + 1]
+
+    def read_page(self, loc):
+        # Reads a page from a memory-mapped volume. Each volume gets
+        # mapped once, so reading many pages of it costs no system calls.
+        if not (entry := self.maps.get(loc.Path)):
+            f = open(loc.Path, 'rb')
+            entry = self.maps[loc.Path] = (f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ))
+        return entry[1][loc.Start:loc.End].decode('utf-8')
+
+    def unmap(self, path):
+        # A volume that changed on disk must not be read through its old
+        # mapping, which may be shorter or belong to a replaced file.
+        if entry := self.maps.pop(path, None):
+            entry[1].close()
+            entry[0].close()
+
+    def close(self):
+        for path in list(self.maps):
+            self.unmap(path)
+
+
+def volume_stamp(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def scan_volume(path):
+    pages = []
+    page, offset, line_num = None, 0, 0
+    with open(path, 'rb') as f:
+        for line in f:
+            line_num += 1
+            if line.startswith(b'# Date: ') and \
+                    (m := PAGE_HEADER_RE.match(line)):
+                if page:
+                    pages.append(page + (offset, line_num - 1))
+                date, page_id, label = (g.decode('utf-8') for g in m.groups())
+                page = (page_id, date, label, offset, line_num)
+            offset += len(line)
+    if page:
+        pages.append(page + (offset, line_num))
+    return pages
+
+
+def parse_page_spec(spec, index):
+    # Parses a comma-separated list of page IDs and page ranges,
+    # such as "1395917,1395920-1395925".
+    page_ids = []
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        if last:
+            page_ids.extend(index.page_range(first, last))
+        else:
+            page_ids.append(first)
+    for page_id in page_ids:
+        if page_id not in index:
+            raise KeyError(f'unknown page: {page_id}')
+    return page_ids
+
+
+if __name__ == '__main__':
+    from process import Processor
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('pages', help='page IDs and ranges, '
+                           'such as 1395917,1395920-1395925')
+    argparser.add_argument('--text', action='store_true',
+                           help='print the proofread text of the pages')
+    args = argparser.parse_args()
+    p = Processor(cachedir='cache')
+    index = p.page_index()
+    try:
+        page_ids = parse_page_spec(args.pages, index)
+    except (KeyError, ValueError) as err:
+        argparser.error(err.args[0])
+    for page_id in page_ids:
+        loc = index.locate(page_id)
+        if args.text:
+            sys.stdout.write(index.read_page(loc))
+        else:
+            print(f'{loc.PageID} {loc.Date} page {loc.Label}: '
+                  f'{os.path.relpath(loc.Path)} '
+                  f'lines {loc.FirstLine}-{loc.LastLine}, '
+                  f'bytes {loc.Start}-{loc.End}')
+    index.close()
@@ -3,11 +3,42 @@
 #
 # Process Bern address books (1861-1945), using data produced by fetch.py.
 
-from collections import Counter, namedtuple
+import argparse
+import array
+import cProfile
+from collections import Counter, OrderedDict, namedtuple
 import csv
+import hashlib
 import inspect
+import json
+import mmap
+import multiprocessing
 import os
+import pickle
 import re
+import sys
+import time
+
+from pageindex import PageIndex, parse_page_spec
+from sinks import open_sinks
+from topk import TopKCounter
+
+
+# Bump whenever the content or layout of the lookup table snapshot changes,
+# so that stale snapshots in the cache directory get rebuilt.
+LOOKUP_SNAPSHOT_VERSION = 4
+
+# Bump whenever a change to the parser can change its output, so that
+# volume shards cached by incremental runs get invalidated.
+PARSER_VERSION = 6
+
+
+# Fragments of given names that are accepted although they are
+# no given names, such as "Wwe." for a widow.
+ACCEPTED_AFFIXES = {
+    'Frau', 'Frl', 'Frl.', 'Gebr.', 'Gebrüder', 'Jgfr.', 'Schwest.',
+    'Schwestern', 'Wittwe', 'Wwe.',
+}
 
 
 Record = namedtuple('Record', [
@@ -16,34 +47,452 @@ Record = namedtuple('Record', [
 ])
 
 
+class FamilyTrie(object):
+    # Prefix index over the words of family names, such as "von Graffenried"
+    # or "de Watteville". Each node is a dict from a lowercased word to the
+    # child node; the value of a family name that ends at some node is kept
+    # in that node under the empty string, which can never be a word.
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def build(families):
+        root = {}
+        for key, value in families.items():
+            words = key.split(' ')
+            # split_family_name joins words with single spaces,
+            # so keys with other whitespace can never match.
+            if any(len(w.split()) != 1 for w in words):
+                continue
+            node = root
+            for word in words:
+                node = node.setdefault(word, {})
+            node[''] = value
+        return FamilyTrie(root)
+
+    def longest_match(self, words):
+        # Returns the longest family name that is a prefix of words,
+        # the number of words it spans, and how many family names
+        # are prefixes of words; more than one means the match was
+        # ambiguous because a shorter family name would also have fit.
+        node, match, depth, num_matches = self.root, None, 0, 0
+        for i, word in enumerate(words):
+            node = node.get(word.lower())
+            if node is None:
+                break
+            if value := node.get(''):
+                match, depth = value, i + 1
+                num_matches += 1
+        return match, depth, num_matches
+
+
+class StreetMatcher(object):
+    # Finds the street name closest to an OCR-damaged one, such as
+    # "Bnndesgasse" for "Bundesgasse", within a small edit distance.
+    # Like in SymSpell, every street name is indexed under all variants
+    # that have up to max_distance characters deleted; a query then only
+    # needs to look up its own deletion variants, instead of comparing
+    # itself against every street name.
+    def __init__(self, index, max_distance=2):
+        self.max_distance = max_distance
+        self.index = index
+
+    @staticmethod
+    def build(streets, max_distance=2):
+        index = {}
+        for street in sorted(streets):
+            for variant in deletion_variants(street, max_distance):
+                index.setdefault(variant, []).append(street)
+        # Tuples unpickle several times faster than lists.
+        index = {variant: tuple(s) for variant, s in index.items()}
+        return StreetMatcher(index, max_distance)
+
+    def match(self, word):
+        # Short words are too likely to match the wrong street,
+        # and street names always start with an uppercase letter.
+        max_distance = min(self.max_distance, (len(word) - 2) // 4)
+        if max_distance < 1 or not word[0].isupper():
+            return None
+        best, best_distance, num_best = None, max_distance + 1, 0
+        masks = char_masks(word)
+        seen = set()
+        for variant in deletion_variants(word, max_distance):
+            for street in self.index.get(variant, ()):
+                if street in seen:
+                    continue
+                seen.add(street)
+                dist = edit_distance(word, street, max_distance, masks)
+                if dist < best_distance:
+                    best, best_distance, num_best = street, dist, 1
+                elif dist == best_distance:
+                    num_best += 1
+        # Ambiguous corrections are worse than none.
+        return best if num_best == 1 else None
+
+
+def deletion_variants(word, max_distance):
+    variants, frontier = {word}, {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i+1:] for w in frontier for i in range(len(w))}
+        variants.update(frontier)
+    return variants
+
+
+def char_masks(word):
+    # For each character, a bit mask of its positions in word.
+    masks = {}
+    for i, c in enumerate(word):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+
+def edit_distance(a, b, max_distance, masks=None):
+    # Levenshtein distance, or max_distance + 1 if it would be larger.
+    # Uses the bit-parallel algorithm of Myers (1999), as formulated by
+    # Hyyrö (2001): each column of the matrix is held in a few ints, one
+    # bit per character of a, so the inner loop over a runs in the CPU
+    # instead of the interpreter. Pass masks = char_masks(a) to compare
+    # the same word against many others.
+    too_far = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return too_far
+    if a == b:
+        return 0
+    if not a:
+        return len(b)
+    if masks is None:
+        masks = char_masks(a)
+    full, last = (1 << len(a)) - 1, 1 << (len(a) - 1)
+    pv, mv, dist = full, 0, len(a)
+    for c in b:
+        eq = masks.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            dist += 1
+        elif mh & last:
+            dist -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return dist if dist <= max_distance else too_far
+
+
+class AddressRegister(object):
+    # Compact, column-oriented form of the official address register.
+    # Instead of one tuple per address, rows are sorted by street and
+    # stored in arrays; street names, postcodes and cities are kept once
+    # and referred to by number. For each street, a dict maps the house
+    # numbers to their offset from the first row of the street; these
+    # offsets are small ints, which Python shares instead of allocating.
+    def __init__(self, table):
+        self.table = table
+        self.street_names = table['streets']
+        self.street_ids = {s: i for i, s in enumerate(self.street_names)}
+        self.street_starts = table['street_starts']
+        self.housenumbers = table['housenumbers']
+        self.postcodes = table['postcodes']
+        self.cities = table['cities']
+        self.postcode_ids = table['postcode_ids']
+        self.city_ids = table['city_ids']
+        self.lats = table['lats']
+        self.lngs = table['lngs']
+
+    @staticmethod
+    def build(addresses):
+        by_street = {}
+        for (street, housenumber), addr in addresses.items():
+            by_street.setdefault(street, []).append((housenumber, addr))
+        streets = sorted(by_street)
+        postcodes = sorted({a[2] for a in addresses.values()})
+        cities = sorted({a[3] for a in addresses.values()})
+        postcode_index = {p: i for i, p in enumerate(postcodes)}
+        city_index = {c: i for i, c in enumerate(cities)}
+        # Only builtin types, so the snapshot can be unpickled no matter
+        # whether this file runs as a script or gets imported.
+        table = {
+            'streets': streets,
+            'street_starts': array.array('I'),
+            'housenumbers': [],
+            'postcodes': postcodes,
+            'cities': cities,
+            'postcode_ids': array.array('H'),
+            'city_ids': array.array('H'),
+            'lats': array.array('d'),
+            'lngs': array.array('d'),
+        }
+        for street in streets:
+            table['street_starts'].append(len(table['lats']))
+            offsets = {}
+            for offset, (housenumber, addr) in enumerate(by_street[street]):
+                _, _, postcode, city, lat, lng = addr
+                offsets[sys.intern(housenumber)] = offset
+                table['postcode_ids'].append(postcode_index[postcode])
+                table['city_ids'].append(city_index[city])
+                table['lats'].append(lat)
+                table['lngs'].append(lng)
+            table['housenumbers'].append(offsets)
+        return AddressRegister(table)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def find_row(self, street, housenumber):
+        street_id = self.street_ids.get(street)
+        if street_id is None:
+            return None
+        offset = self.housenumbers[street_id].get(housenumber)
+        if offset is None:
+            return None
+        return self.street_starts[street_id] + offset
+
+    def get(self, key):
+        # Drop-in replacement for a dict from (street, housenumber)
+        # to (street, housenumber, postcode, city, lat, lng).
+        street, housenumber = key
+        row = self.find_row(street, housenumber)
+        if row is None:
+            return None
+        return (street, housenumber,
+                self.postcodes[self.postcode_ids[row]],
+                self.cities[self.city_ids[row]],
+                self.lats[row], self.lngs[row])
+
+
+class LRUCache(object):
+    # Bounded mapping that evicts the least recently used entry when full.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class ParsePlan(object):
+    # Parsing rules that depend on the era of a volume, compiled once per
+    # publication year instead of being looked up again for every record.
+    # Rules for further eras can be added here as they are found.
+    def __init__(self, year):
+        self.year = year
+        self.address_suffixes = ('Bümpliz', 'Riedbach', 'Oberbottigen', ', ')
+        self.street_abbreviations = (('w.', 'weg'), ('str.', 'strasse'))
+        self.trailing_phone_re = None
+        self.bracketed_phone_re = None
+        self.phone_brackets_re = None
+        if year >= 1900 and year <= 1917:
+            # "Kramgasse 59 1171"
+            self.trailing_phone_re = re.compile(
+                r'^(.+\d(\s?[a-f])?) (\d{2,4})$')
+        elif year >= 1941:
+            # "Kramgasse 59 [2 21 57]"
+            self.bracketed_phone_re = re.compile(r'\[((\d\s*){5})\]')
+            self.phone_brackets_re = re.compile(r'\s?\[.+?\]')
+
+
 class Processor(object):
-    def __init__(self, cachedir):
-        self.families = self.read_families()
-        self.firstnames = self.read_firstnames()
-        self.given_name_abbreviations = self.read_given_name_abbreviations()
-        self.accepted_affixes = { # accepted fragments in firstnames
-          "Frau": True,
-          "Frl": True,
-          "Frl.": True,
-          "Gebr.": True,
-          "Gebrüder": True,
-          "Jgfr.": True,
-          "Schwest.": True,
-          "Schwestern": True,
-          "Wittwe": True,
-          "Wwe.": True
-        };
-        self.read_addresses()
-        self.unknown_families = Counter()
-        self.max_family_name_wordcount = max(
-            len(f.split()) for f in self.families.keys())
+    # Counters that get accumulated while parsing. When volumes are
+    # processed in parallel, each worker reports its counters per volume,
+    # and the parent process merges them back in sorted file order.
+    STATS = (
+        'num_input_records',
+        'good_familyname_count',
+        'bad_familyname_count',
+        'ambiguous_familyname_count',
+        'familyname_match_depths',
+        'good_firstname_count',
+        'bad_firstname_count',
+        'bad_address_count',
+        'fuzzy_street_lookups',
+        'fuzzy_street_seconds',
+        'fuzzy_address_count',
+        'unknown_families',
+        'unknown_given_names',
+        'stage_seconds',
+        'stage_calls',
+        'volume_stats',
+    )
+
+    # Counters of the memos. Since every worker process has its own
+    # memos, these depend on the number of workers, so they are kept
+    # apart from the counters above, which do not.
+    CACHE_STATS = (
+        'given_name_memo_hits',
+        'given_name_memo_misses',
+        'fuzzy_street_memo_hits',
+    )
+
+    # Stages that get timed when instrumentation is enabled.
+    STAGES = (
+        'split_family_name',
+        'split_given_name',
+        'split_phone',
+        'split_address',
+    )
+
+    def __init__(self, cachedir, fuzzy_streets=False, instrument=False,
+                 max_unknown_names=None, keep_unresolved=False):
+        self.cachedir = cachedir
+        self.fuzzy_streets = fuzzy_streets
+        # If set, records whose address is not in the register get
+        # emitted too, with empty Postcode, City and coordinates.
+        self.keep_unresolved = keep_unresolved
+        self.instrument = instrument
+        # If set, only the most frequent unknown names get counted,
+        # so that memory does not grow with the size of the corpus.
+        self.max_unknown_names = max_unknown_names
+        snapshot = self.load_lookup_tables()
+        self.lookup_tables_digests = snapshot['digests']
+        tables = snapshot['tables']
+        self.families = tables['families']
+        self.family_trie = FamilyTrie(tables['family_trie'])
+        self.firstnames = tables['firstnames']
+        self.given_name_abbreviations = tables['given_name_abbreviations']
+        self.addresses = AddressRegister(tables['addresses'])
+        self.streets = self.addresses.street_ids
+        self.parse_plans = {}  # year -> ParsePlan
+        # A few thousand distinct strings, such as "Joh." or "Anna Barb.",
+        # make up almost all given names, so their verdicts get memoized.
+        # The frozen part is never modified, so worker processes can share
+        # it with their parent; the LRU cache is private to each process.
+        self.frozen_given_names = {}  # given name -> bool
+        self.given_name_memo = LRUCache(maxsize=65536)
+        if fuzzy_streets:
+            self.street_matcher = self.load_street_matcher()
+            self.fuzzy_street_memo = {}  # OCR'd street -> street, or None
+        self.reset_stats()
+
+    def reset_stats(self):
         self.num_input_records = 0
         self.good_familyname_count = 0
         self.bad_familyname_count = 0
+        self.ambiguous_familyname_count = 0
+        self.familyname_match_depths = Counter()
         self.good_firstname_count = 0
         self.bad_firstname_count = 0
-        self.unknown_given_names = Counter()
+        self.given_name_memo_hits = 0
+        self.given_name_memo_misses = 0
         self.bad_address_count = 0
+        self.fuzzy_street_lookups = 0
+        self.fuzzy_street_memo_hits = 0
+        self.fuzzy_street_seconds = 0.0
+        self.fuzzy_address_count = 0
+        self.unknown_families = self.make_name_counter()
+        self.unknown_given_names = self.make_name_counter()
+        self.stage_seconds = Counter()  # stage -> cumulative seconds
+        self.stage_calls = Counter()  # stage -> number of calls
+        self.volume_stats = {}  # volume -> records and timing
+
+    def make_name_counter(self):
+        if self.max_unknown_names:
+            return TopKCounter(self.max_unknown_names)
+        return Counter()
+
+    def stats(self):
+        return {name: getattr(self, name)
+                for name in self.STATS + self.CACHE_STATS}
+
+    def merge_stats(self, stats):
+        for name, value in stats.items():
+            if isinstance(value, (int, float)):
+                setattr(self, name, getattr(self, name) + value)
+            else:
+                # Counters add up counts, dicts replace values.
+                getattr(self, name).update(value)
+
+    def lookup_table_sources(self):
+        srcdir = os.path.dirname(__file__)
+        return [
+            os.path.join(srcdir, 'families.txt'),
+            os.path.join(srcdir, 'givennames.csv'),
+            os.path.join(srcdir, 'given_name_abbreviations.csv'),
+            os.path.join(srcdir, '..', 'data', 'pure_adr_be.csv'),
+        ]
+
+    def load_lookup_tables(self):
+        # Parsing the lookup tables from their source files takes much
+        # longer than unpickling them, so we keep a compiled snapshot in
+        # the cache directory. The snapshot gets rebuilt whenever the
+        # content of any source file changes; a changed modification
+        # time alone only causes the snapshot to be re-stamped.
+        path = os.path.join(self.cachedir, 'lookup-tables.pickle')
+        sources = self.lookup_table_sources()
+        stamps = [file_stamp(p) for p in sources]
+        snapshot = None
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                try:
+                    snapshot = pickle.load(f)
+                except (pickle.UnpicklingError, AttributeError, EOFError):
+                    snapshot = None
+            if snapshot and snapshot['version'] != LOOKUP_SNAPSHOT_VERSION:
+                snapshot = None
+        if snapshot and snapshot['stamps'] == stamps:
+            return snapshot
+        digests = [file_digest(p) for p in sources]
+        if not snapshot or snapshot['digests'] != digests:
+            snapshot = {
+                'version': LOOKUP_SNAPSHOT_VERSION,
+                'digests': digests,
+                'tables': self.build_lookup_tables(),
+            }
+        snapshot['stamps'] = stamps
+        os.makedirs(self.cachedir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)  # atomic
+        return snapshot
+
+    def load_street_matcher(self):
+        # Building the deletion index of all street names takes longer
+        # than unpickling it, so it gets cached like the lookup tables.
+        # It lives in a file of its own, because runs without fuzzy
+        # street matching should not have to load it.
+        path = os.path.join(self.cachedir, 'street-index.pickle')
+        key = [LOOKUP_SNAPSHOT_VERSION] + self.lookup_tables_digests
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                try:
+                    snapshot = pickle.load(f)
+                except (pickle.UnpicklingError, AttributeError, EOFError):
+                    snapshot = None
+            if snapshot and snapshot['key'] == key:
+                return StreetMatcher(snapshot['index'])
+        matcher = StreetMatcher.build(self.streets)
+        os.makedirs(self.cachedir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'key': key, 'index': matcher.index}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)  # atomic
+        return matcher
+
+    def build_lookup_tables(self):
+        families = self.read_families()
+        addresses = self.read_addresses()
+        return {
+            'families': families,
+            # Only builtin types, so the snapshot can be unpickled no matter
+            # whether this file runs as a script or gets imported.
+            'family_trie': FamilyTrie.build(families).root,
+            'firstnames': self.read_firstnames(),
+            'given_name_abbreviations': self.read_given_name_abbreviations(),
+            'addresses': AddressRegister.build(addresses).table,
+        }
 
     def read_families(self):
         result = {}
@@ -58,11 +507,9 @@ class Processor(object):
     def read_firstnames(self):
         result = {}
         filepath = os.path.join(os.path.dirname(__file__), 'givennames.csv')
-        for line in open(filepath):
-            line = list(csv.reader([line.strip()]))
-            key = line[0][0].lower()
-            value = line[0][1]
-            result[key.lower()] = (line[0][0], value)
+        with open(filepath, newline='') as stream:
+            for name, wikidata_id in csv.reader(stream):
+                result[name.lower()] = (name, wikidata_id)
         return result
 
     def read_given_name_abbreviations(self):
@@ -74,8 +521,7 @@ class Processor(object):
         return abbrevs
 
     def read_addresses(self):
-        self.streets = set()
-        self.addresses = {}
+        addresses = {}
         filepath = os.path.join(
             os.path.dirname(__file__), '..', 'data', 'pure_adr_be.csv')
         for line in open(filepath, 'r'):
@@ -86,85 +532,290 @@ class Processor(object):
             if city != 'Bern':
                 continue
             lat, lng = round(float(lat), 6), round(float(lng), 6)
-            self.addresses[(street, housenumber)] = (street, housenumber, postcode, city, lat, lng)
-            self.streets.add(street)
+            addresses[(street, housenumber)] = (street, housenumber, postcode, city, lat, lng)
+        return addresses
 
-    def process_proofread(self):
+    def volume_paths(self):
         dirpath = os.path.join(os.path.dirname(__file__), '..', 'proofread')
-        page_re = re.compile(
-            r'^# Date: (\d{4}-\d\d-\d\d) Page: (\d+)/([\[\]\d]+)$')
+        paths = []
         for filename in sorted(os.listdir(dirpath)):
             if not filename.endswith('.txt'):
                 continue
             #if filename[:4] not in ('1944'):
             #    continue
-            path = os.path.join(dirpath, filename)
-            publication_date, page_id, page_label = None, None, None
-            line_num = 0
-            family = None
-            for line in open(path):
-                line_num += 1
-                line = line.strip()
-                if len(line) == 0:
+            paths.append(os.path.join(dirpath, filename))
+        return paths
+
+    def process_proofread(self, workers=1, incremental=False):
+        paths = self.volume_paths()
+        if workers == 1 and not incremental:
+            for path in paths:
+                yield from self.process_volume(path)
+            return
+        for records, stats in self.process_volumes(paths, workers, incremental):
+            self.merge_stats(stats)
+            yield from records
+
+    def process_volumes(self, paths, workers, incremental):
+        # In incremental mode, the records and stats of each volume get
+        # cached as a shard, and only volumes without an up-to-date shard
+        # are parsed again.
+        keys, shards = {}, {}
+        if incremental:
+            for path in paths:
+                keys[path] = self.volume_cache_key(path)
+                if shard := self.read_volume_shard(path, keys[path]):
+                    shards[path] = shard
+        todo = [path for path in paths if path not in shards]
+        if workers == 1 or len(todo) < 2:
+            yield from self.merge_volumes(
+                paths, shards, keys, map(self.run_volume_rows, todo))
+            return
+        self.freeze_given_name_memo()
+        # Each volume is a separate job. Pool.imap returns results in
+        # the order of its input, so the merged output is identical
+        # to a serial run.
+        with multiprocessing.Pool(min(workers, len(todo)),
+                                  initializer=init_worker,
+                                  initargs=(self,)) as pool:
+            yield from self.merge_volumes(
+                paths, shards, keys, pool.imap(process_volume_job, todo))
+
+    def merge_volumes(self, paths, shards, keys, results):
+        for path in paths:
+            if shard := shards.get(path):
+                yield map(Record._make, shard['records']), shard['stats']
+                continue
+            rows, stats = next(results)
+            if path in keys:
+                self.write_volume_shard(path, keys[path], rows, stats)
+            yield map(Record._make, rows), stats
+
+    def run_volume(self, path):
+        return self.run_isolated(self.process_volume(path))
+
+    def run_volume_rows(self, path):
+        # Like run_volume, but with the records as plain tuples, which
+        # pickle and unpickle much faster than namedtuples. This matters
+        # for worker processes, whose results the parent unpickles.
+        records, stats = self.run_volume(path)
+        return [tuple(r) for r in records], stats
+
+    def run_pages(self, page_ids, index):
+        return self.run_isolated(self.process_pages(page_ids, index))
+
+    def run_isolated(self, records):
+        # Consumes a record generator with fresh stats, and returns
+        # its records and stats without touching the current stats.
+        saved = self.stats()
+        self.reset_stats()
+        records = list(records)
+        stats = self.stats()
+        for name, value in saved.items():
+            setattr(self, name, value)
+        return records, stats
+
+    def parser_options(self):
+        # Options that can change the output, and hence the cache keys.
+        return {
+            'fuzzy_streets': self.fuzzy_streets,
+            'keep_unresolved': self.keep_unresolved,
+            'max_unknown_names': self.max_unknown_names,
+        }
+
+    def volume_cache_key(self, path):
+        key = hashlib.sha256()
+        key.update(f'{PARSER_VERSION}\n'.encode('utf-8'))
+        key.update(f'{sorted(self.parser_options().items())}\n'.encode('utf-8'))
+        for digest in self.lookup_tables_digests:
+            key.update(f'{digest}\n'.encode('utf-8'))
+        key.update(file_digest(path).encode('utf-8'))
+        return key.hexdigest()
+
+    def volume_shard_path(self, path):
+        filename = os.path.basename(path).removesuffix('.txt') + '.pickle'
+        return os.path.join(self.cachedir, 'volumes', filename)
+
+    def read_volume_shard(self, path, key):
+        shard_path = self.volume_shard_path(path)
+        if not os.path.exists(shard_path):
+            return None
+        with open(shard_path, 'rb') as f:
+            shard = pickle.load(f)
+        return shard if shard['key'] == key else None
+
+    def write_volume_shard(self, path, key, rows, stats):
+        shard_path = self.volume_shard_path(path)
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        # Plain tuples unpickle much faster than namedtuples.
+        shard = {'key': key, 'records': rows, 'stats': stats}
+        with open(shard_path + '.tmp', 'wb') as f:
+            pickle.dump(shard, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(shard_path + '.tmp', shard_path)  # atomic
+
+    def process_volume(self, path):
+        volume = os.path.basename(path).removesuffix('.txt')
+        yield from self.process_lines(read_lines(path), path, volume=volume)
+
+    def page_index(self):
+        index = PageIndex(os.path.join(self.cachedir, 'page-index.pickle'),
+                          self.volume_paths())
+        index.update()
+        return index
+
+    def process_pages(self, page_ids, index=None):
+        # Parses only the given pages, reading each of them from a
+        # memory-mapped slice of its volume.
+        if index is None:
+            index = self.page_index()
+        for page_id in page_ids:
+            loc = index.locate(page_id)
+            lines = read_lines(loc.Path, loc.Start, loc.End)
+            yield from self.process_lines(
+                lines, loc.Path, first_line_num=loc.FirstLine)
+
+    def process_lines(self, lines, path, first_line_num=1, volume=None):
+        # Parses the lines of a volume, or a part of it that starts with
+        # a page header. If volume is set, its stats get recorded.
+        page_re = re.compile(
+            r'^# Date: (\d{4}-\d\d-\d\d) Page: (\d+)/([\[\]\d]+)$')
+        split_family_name = self.split_family_name
+        split_given_name = self.split_given_name
+        split_phone = self.split_phone
+        split_address = self.split_address
+        keep_unresolved = self.keep_unresolved
+        if self.instrument:
+            split_family_name = self.timed('split_family_name', split_family_name)
+            split_given_name = self.timed('split_given_name', split_given_name)
+            split_phone = self.timed('split_phone', split_phone)
+            split_address = self.timed('split_address', split_address)
+            lines = self.timed_lines(lines)
+        # Time spent by callers while this generator is suspended
+        # does not count towards the time for this volume.
+        seconds, resumed = 0.0, time.perf_counter()
+        num_input_records, num_output_records = self.num_input_records, 0
+        publication_date, page_id, page_label = None, None, None
+        # Nothing may carry over from a previously parsed volume or page,
+        # which matters for long-running processes such as watch.py.
+        self.publication_date, self.page_id, self.page_label = None, None, None
+        self.parse_plan = None
+        line_num = first_line_num - 1
+        family = None
+        for line in lines:
+            line_num += 1
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if line[0] == '#':
+                if m := page_re.match(line):
+                    publication_date, page_id, page_label = m.groups()
+                    self.publication_date = publication_date
+                    self.page_id = page_id
+                    self.page_label = page_label
+                    self.parse_plan = self.get_parse_plan(publication_date)
+                    family = None
                     continue
-                if line[0] == '#':
-                    if m := page_re.match(line):
-                        publication_date, page_id, page_label = m.groups()
-                        self.publication_date = publication_date
-                        self.page_id = page_id
-                        self.page_label = page_label
-                        family = None
-                        continue
-                    else:
-                        raise ValueError(
-                            f'{path}:{line_num}: Unknown # directive: {line}')
-                self.num_input_records += 1
-                if line[0] in ('—', '–', '-'):
-                    rest = line[1:].strip()
                 else:
-                    family, rest = self.split_family_name(line)
-
-                firstname = None
-                if family and rest:
-                    firstname, rest = self.split_given_name(rest);
-
-                phone, rest = self.split_phone(rest)
-                address, rest = self.split_address(rest)
-                if not address:
-                    self.bad_address_count += 1
-                if family and firstname and address:
-                    (street, housenumber, postcode, city, lat, lng) = address
-                    yield Record(
-                        Name=firstname,
-                        Surname=family,
-                        Date=self.publication_date,
-                        Street=street,
-                        Housenumber=housenumber,
-                        Postcode=postcode,
-                        City=city,
-                        Latitude=lat,
-                        Longitude=lng,
-                        Phone=(';'.join(phone) if phone else ''),
-                        PageID=self.page_id,
-                        Page=self.page_label)
-                #print(family, phone, rest)
+                    raise ValueError(
+                        f'{path}:{line_num}: Unknown # directive: {line}')
+            if publication_date is None:
+                raise ValueError(
+                    f'{path}:{line_num}: Record before first page header')
+            self.num_input_records += 1
+            if line[0] in ('—', '–', '-'):
+                rest = line[1:].strip()
+            else:
+                family, rest = split_family_name(line)
+
+            firstname = None
+            if family and rest:
+                firstname, rest = split_given_name(rest);
+
+            phone, rest = split_phone(rest)
+            address, rest = split_address(rest)
+            if not address:
+                self.bad_address_count += 1
+                # Left for geocode.py, which may still resolve the
+                # address later, such as through alternate street names.
+                if keep_unresolved and family and firstname and \
+                        (parts := self.split_street(rest)):
+                    address = (parts[0], parts[1], '', '', None, None)
+            if family and firstname and address:
+                (street, housenumber, postcode, city, lat, lng) = address
+                record = Record(
+                    Name=firstname,
+                    Surname=family,
+                    Date=self.publication_date,
+                    Street=street,
+                    Housenumber=housenumber,
+                    Postcode=postcode,
+                    City=city,
+                    Latitude=lat,
+                    Longitude=lng,
+                    Phone=(';'.join(phone) if phone else ''),
+                    PageID=self.page_id,
+                    Page=self.page_label)
+                num_output_records += 1
+                seconds += time.perf_counter() - resumed
+                yield record
+                resumed = time.perf_counter()
+            #print(family, phone, rest)
+        seconds += time.perf_counter() - resumed
+        if volume is None:
+            return
+        self.volume_stats[volume] = {
+            'input_records': self.num_input_records - num_input_records,
+            'output_records': num_output_records,
+            'seconds': seconds,
+        }
+
+    def timed(self, stage, func):
+        def timed_func(*args):
+            start = time.perf_counter()
+            result = func(*args)
+            self.stage_seconds[stage] += time.perf_counter() - start
+            self.stage_calls[stage] += 1
+            return result
+        return timed_func
+
+    def timed_lines(self, lines):
+        # Times how long it takes to read each line from the file.
+        lines = iter(lines)
+        while True:
+            start = time.perf_counter()
+            line = next(lines, None)
+            self.stage_seconds['read'] += time.perf_counter() - start
+            if line is None:
+                return
+            self.stage_calls['read'] += 1
+            yield line
+
+    def get_parse_plan(self, date):
+        year = int(date[:4])
+        if not (plan := self.parse_plans.get(year)):
+            plan = self.parse_plans[year] = ParsePlan(year)
+        return plan
 
     def split_family_name(self, line):
         line = line.removeprefix(',')
         line = line.replace(' - ', '-')
         if line.startswith('v.'):
             line = 'von ' + line[3:].strip()
-        frags = line.split(',')
-        words = frags[0].split()
-        for n in reversed(range(self.max_family_name_wordcount)):
-            name_key = ' '.join(words[:n+1]).lower()
-            if name := self.families.get(name_key):
-                self.good_familyname_count += 1
-                return (name[0], ','.join(frags[1:]))
+        # Everything after the first comma gets passed on as it is,
+        # without splitting it into fragments and joining them again.
+        head, _, rest = line.partition(',')
+        words = head.split()
+        name, depth, num_matches = self.family_trie.longest_match(words)
+        if name:
+            self.good_familyname_count += 1
+            self.familyname_match_depths[depth] += 1
+            if num_matches > 1:
+                self.ambiguous_familyname_count += 1
+            return (name[0], rest)
         self.unknown_families[words[0]] += 1
         self.report_unknown_name(line)
         self.bad_familyname_count += 1
-        return (None, ','.join(frags[1:]))
+        return (None, rest)
 
     def report_unknown_name(self, line):
         #print(inspect.stack()[1].function + ": " + line)
@@ -172,58 +823,124 @@ class Processor(object):
         pass
 
     def split_given_name(self, line):
-        parts = line.split(',')
-        firstname = parts[0].strip()
-        firstname_frags = firstname.split(' ')
-        all_frags_found = True
-        for frag in firstname_frags:
-            if frag in self.given_name_abbreviations:
-                continue
-            if self.firstnames.get(frag.lower()):
-                continue
-            if self.accepted_affixes.get(frag):
-                continue
-            all_frags_found = False
+        firstname = line.partition(',')[0].strip()
+        all_frags_found = self.is_known_given_name(firstname)
         if all_frags_found:
             self.good_firstname_count += 1
-            return (firstname, ','.join(parts))
+            return (firstname, line)
         self.unknown_given_names[firstname] += 1
         self.report_unknown_name(line)
         self.bad_firstname_count += 1
         return (None, line)
 
+    def is_known_given_name(self, firstname):
+        known = self.frozen_given_names.get(firstname)
+        if known is None:
+            known = self.given_name_memo.get(firstname)
+        if known is not None:
+            self.given_name_memo_hits += 1
+            return known
+        self.given_name_memo_misses += 1
+        known = True
+        for frag in firstname.split(' '):
+            if frag in self.given_name_abbreviations:
+                continue
+            if self.firstnames.get(frag.lower()):
+                continue
+            if frag in ACCEPTED_AFFIXES:
+                continue
+            known = False
+        self.given_name_memo.put(firstname, known)
+        return known
+
+    def seed_given_name_memo(self, path):
+        # Warms the memo with the given names that the previous run
+        # could not recognize, as written to givennames.unknown.csv.
+        # Their verdicts are computed afresh, since givennames.csv
+        # may have been extended in the meantime.
+        with open(path, newline='') as stream:
+            for row in csv.reader(stream):
+                if row:
+                    self.is_known_given_name(row[0])
+        self.freeze_given_name_memo()
+
+    def freeze_given_name_memo(self):
+        self.frozen_given_names.update(self.given_name_memo.entries)
+        self.given_name_memo = LRUCache(self.given_name_memo.maxsize)
+
     def split_address(self, line):
-        for suffix in ['Bümpliz', 'Riedbach', 'Oberbottigen', ', ']:
+        if not (parts := self.split_street(line)):
+            return None, line
+        street, housenumber, rest = parts
+        if addr := self.addresses.get((street, housenumber)):
+            return addr, rest
+        if self.fuzzy_streets and street not in self.streets:
+            fuzzy_street = self.match_street(street)
+            if addr := self.addresses.get((fuzzy_street, housenumber)):
+                self.fuzzy_address_count += 1
+                return addr, rest
+        return None, line
+
+    def split_street(self, line):
+        # Returns (street, housenumber, rest of line), or None.
+        for suffix in self.parse_plan.address_suffixes:
             line = line.removesuffix(suffix)
-        frags = line.split(',')
-        tokens = frags[-1].strip().split(' ')
+        # Only the last two words after the last comma get split off;
+        # the rest of the line stays in one piece.
+        tokens = line.rpartition(',')[2].strip().rsplit(' ', 2)
         if len(tokens) < 2:
-            return None, line
+            return None
         street, housenumber = tokens[-2], tokens[-1]
+        rest = tokens[0].removesuffix(',') if len(tokens) == 3 else ''
         # FIXME: heavy chances of phone here
         if street and street[-1] == '.':
-            for abbr, full in [('w.', 'weg'), ('str.', 'strasse')]:
+            for abbr, full in self.parse_plan.street_abbreviations:
                 if street.endswith(abbr):
                     street = street.removesuffix(abbr) + full
                     break
-        if addr := self.addresses.get((street, housenumber)):
-            return addr, ' '.join(tokens[:-2]).removesuffix(',')
-        return None, line
+        return street, housenumber, rest
+
+    def match_street(self, street):
+        self.fuzzy_street_lookups += 1
+        if street in self.fuzzy_street_memo:
+            self.fuzzy_street_memo_hits += 1
+            return self.fuzzy_street_memo[street]
+        start = time.perf_counter()
+        match = self.street_matcher.match(street)
+        self.fuzzy_street_seconds += time.perf_counter() - start
+        self.fuzzy_street_memo[street] = match
+        return match
 
     def split_phone(self, line):
-        year = int(self.publication_date[:4])
+        plan = self.parse_plan
         phone = None
-        if year >= 1900 and year <= 1917:
-            if m := re.match(r'^(.+\d(\s?[a-f])?) (\d{2,4})$', line):
+        if plan.trailing_phone_re:
+            if m := plan.trailing_phone_re.match(line):
                 line, _, phone = m.groups()
                 phone = [phone]
-        elif year >= 1941:
-            if m := re.findall(r'\[((\d\s*){5})\]', line):
-                phone = [normalize_phone(p[0], year) for p in m]
-            line = re.sub(r'\s?\[.+?\]', '', line)
+        elif plan.bracketed_phone_re and '[' in line:
+            if m := plan.bracketed_phone_re.findall(line):
+                phone = [normalize_phone(p[0], plan.year) for p in m]
+            line = plan.phone_brackets_re.sub('', line)
         return phone, line
 
 
+def read_lines(path, start=0, end=None):
+    # Reads a volume, or the part of it between two byte offsets at line
+    # boundaries, through a memory map. Each line gets stripped while
+    # still in bytes and only then decoded, so neither the whole volume
+    # nor the newlines get decoded.
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            m.seek(start)
+            if end is None:
+                end = len(m)
+            while m.tell() < end:
+                yield m.readline().strip().decode('utf-8')
+
+
 def normalize_phone(phone, year):
      d = phone.replace(' ', '')
      if year >= 1944:
@@ -231,43 +948,206 @@ def normalize_phone(phone, year):
      return ''
 
 
-def read_wikidata_family_names():
-        import gzip, io
-        result = {}
-        filepath = os.path.join('cache', 'wikidata_family_names.csv.gz')
-        with gzip.open(filepath, mode='rb') as bytestream:
-            with io.TextIOWrapper(bytestream, encoding='utf-8') as stream:
-                for row in csv.DictReader(stream):
-                    name, id = row['Name'], row['WikidataID']
-                    result[name] = id
-        return result
+def percent(part, total):
+    return int(part * 100.0 / max(total, 1) + 0.5)
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Set in each worker process of the pool used by process_proofread().
+worker_processor = None
+
+
+def init_worker(processor):
+    global worker_processor
+    worker_processor = processor
+
+
+def process_volume_job(path):
+    return worker_processor.run_volume_rows(path)
+
+
+def start_profiler(kind):
+    if kind == 'pyinstrument':
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler, path_prefix):
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        path = path_prefix + '.prof'
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = path_prefix + '.html'
+        with open(path, 'w') as f:
+            f.write(profiler.output_html())
+    return path
+
+
+def write_report(p, path, num_output_records, seconds):
+    # Machine-readable summary of a run, for tracking regressions.
+    counters = {name: getattr(p, name) for name in p.STATS
+                if isinstance(getattr(p, name), (int, float))}
+    stages = {}
+    for stage in sorted(p.stage_seconds):
+        stages[stage] = {
+            'calls': p.stage_calls[stage],
+            'seconds': round(p.stage_seconds[stage], 6),
+        }
+    volumes = {}
+    for volume, stats in sorted(p.volume_stats.items()):
+        volumes[volume] = dict(stats)
+        volumes[volume]['seconds'] = round(stats['seconds'], 6)
+        volumes[volume]['records_per_second'] = round(
+            stats['input_records'] / max(stats['seconds'], 1e-9), 1)
+    report = {
+        'parser_version': PARSER_VERSION,
+        'options': p.parser_options(),
+        'seconds': round(seconds, 6),
+        'output_records': num_output_records,
+        'counters': counters,
+        'cache': {name: getattr(p, name) for name in p.CACHE_STATS},
+        'distinct_unknown_families': len(p.unknown_families),
+        'distinct_unknown_given_names': len(p.unknown_given_names),
+        'familyname_match_depths': {
+            str(depth): count
+            for depth, count in sorted(p.familyname_match_depths.items())},
+        'stages': stages,
+        'volumes': volumes,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
 
 
 if __name__ == '__main__':
-    # wd = read_wikidata_family_names()
-    p = Processor(cachedir='cache')
-    with open('bern-address-book.csv', 'w') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['Name', 'Surname', 'Date', 'Street', 'Housenumber', 'Postcode', 'City', 'Latitude', 'Longitude', 'Phone', 'PageID', 'Page'])
-        num_output_records = 0
-        for rec in p.process_proofread():
-            num_output_records += 1
-            writer.writerow([rec.Name, rec.Surname, rec.Date,
-                             rec.Street, rec.Housenumber, rec.Postcode,
-                             rec.City, rec.Latitude, rec.Longitude,
-                             rec.Phone,
-                             rec.PageID, rec.Page])
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of worker processes; 0 for one per CPU core')
+    argparser.add_argument(
+        '--incremental', action='store_true',
+        help='only re-parse volumes that changed since the last run')
+    argparser.add_argument(
+        '--pages', metavar='SPEC',
+        help='only process these pages, such as 1395917,1395920-1395925')
+    argparser.add_argument(
+        '--fuzzy-streets', action='store_true',
+        help='accept OCR-damaged street names close to a known street; '
+             'a full run takes about a third longer')
+    argparser.add_argument(
+        '--keep-unresolved', action='store_true',
+        help='also write records whose address is not in the register, '
+             'for geocoding them later with geocode.py')
+    argparser.add_argument(
+        '--seed-given-names', metavar='PATH',
+        help='warm the given name memo, e.g. from givennames.unknown.csv')
+    argparser.add_argument(
+        '--output', metavar='SPEC', action='append',
+        help='where to write the address book, see sinks.py; may be '
+             'repeated; default: bern-address-book.csv, or stdout '
+             'with --pages')
+    argparser.add_argument(
+        '--unknown-given-names', metavar='PATH',
+        help='where to write the unknown given names; default: '
+             'givennames.unknown.csv, or nowhere with --pages')
+    argparser.add_argument(
+        '--report', metavar='PATH',
+        help='where to write stats and timings as JSON; default: '
+             'bern-address-book.stats.json, or nowhere with --pages')
+    argparser.add_argument(
+        '--max-unknown-names', type=int, metavar='N',
+        help='only count the N most frequent unknown names, in bounded memory')
+    argparser.add_argument(
+        '--stage-timings', action='store_true',
+        help='time every parsing stage; this slows down parsing')
+    argparser.add_argument(
+        '--profile', choices=['cprofile', 'pyinstrument'],
+        help='profile the run; with --workers, only the main process')
+    args = argparser.parse_args()
+    workers = args.workers or os.cpu_count()
+    # A run over some pages must not replace the files of a full run.
+    if not args.pages:
+        args.output = args.output or ['bern-address-book.csv']
+        args.unknown_given_names = (args.unknown_given_names or
+                                    'givennames.unknown.csv')
+        args.report = args.report or 'bern-address-book.stats.json'
+    outputs = args.output or ['-']
+    # Keep the summary out of the address book when that goes to stdout.
+    log = sys.stderr if '-' in outputs else sys.stdout
+    start_time = time.perf_counter()
+    profiler = start_profiler(args.profile) if args.profile else None
+    p = Processor(cachedir='cache', fuzzy_streets=args.fuzzy_streets,
+                  instrument=args.stage_timings,
+                  max_unknown_names=args.max_unknown_names,
+                  keep_unresolved=args.keep_unresolved)
+    if args.seed_given_names and os.path.exists(args.seed_given_names):
+        p.seed_given_name_memo(args.seed_given_names)
+        p.reset_stats()
+    if args.pages:
+        # Checked before opening the sinks, which would replace their files.
+        index = p.page_index()
+        try:
+            page_ids = parse_page_spec(args.pages, index)
+        except (KeyError, ValueError) as err:
+            argparser.error(err.args[0])
+    sink = open_sinks(outputs)
+    num_output_records = 0
+    if args.pages:
+        records = p.process_pages(page_ids, index)
+    else:
+        records = p.process_proofread(
+            workers=workers, incremental=args.incremental)
+    for rec in records:
+        num_output_records += 1
+        write_start = time.perf_counter()
+        sink.write(rec)
+        if args.stage_timings:
+            p.stage_seconds['write'] += time.perf_counter() - write_start
+            p.stage_calls['write'] += 1
+    sink.close()
 
     # write out unknown firstnames
-    with open('givennames.unknown.csv', 'w') as fp:
-        csvw = csv.writer(fp)
-        csvw.writerows(p.unknown_given_names.most_common())
+    if args.unknown_given_names:
+        with open(args.unknown_given_names, 'w') as fp:
+            csvw = csv.writer(fp)
+            csvw.writerows(p.unknown_given_names.most_common())
+
+    if profiler:
+        print(f'profile: {stop_profiler(profiler, "bern-address-book")}', file=log)
+    if args.report:
+        write_report(p, args.report, num_output_records,
+                     time.perf_counter() - start_time)
 
     total_familyname_count = p.good_familyname_count + p.bad_familyname_count
-    good_percent = int(p.good_familyname_count * 100.0 / total_familyname_count + 0.5)
+    good_percent = percent(p.good_familyname_count, total_familyname_count)
     total_firstname_count = p.good_firstname_count + p.bad_firstname_count
-    good_firstname_percent = int(p.good_firstname_count * 100.0 / total_firstname_count + 0.5)
-    print(f'records: input {p.num_input_records} -> output {num_output_records} = {int(num_output_records * 100.0 / p.num_input_records + 0.5)}%')
-    print(f'family names: total {total_familyname_count}; known: {p.good_familyname_count} = {good_percent}%')
-    print(f'firstnames: total {total_firstname_count}; known: {p.good_firstname_count} = {good_firstname_percent}%')
+    good_firstname_percent = percent(p.good_firstname_count, total_firstname_count)
+    print(f'records: input {p.num_input_records} -> output {num_output_records} = {percent(num_output_records, p.num_input_records)}%', file=log)
+    print(f'family names: total {total_familyname_count}; known: {p.good_familyname_count} = {good_percent}%', file=log)
+    print(f'firstnames: total {total_firstname_count}; known: {p.good_firstname_count} = {good_firstname_percent}%', file=log)
+    if p.fuzzy_streets:
+        num_matched = p.fuzzy_street_lookups - p.fuzzy_street_memo_hits
+        print(f'fuzzy streets: lookups {p.fuzzy_street_lookups}; '
+              f'{int(num_matched / max(p.fuzzy_street_seconds, 1e-9))} matches/s '
+              f'in {p.fuzzy_street_seconds:.1f}s; '
+              f'resolved addresses {p.fuzzy_address_count}', file=log)
 
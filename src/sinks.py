@@ -0,0 +1,109 @@
+# SPDX-License-Identifier: MIT
+#
+# Output sinks for the Record stream produced by process.py. A sink gets
+# specified on the command line, for example:
+#
+#   bern-address-book.csv      CSV file
+#   bern-address-book.csv.gz   gzip-compressed CSV file
+#   -                          CSV on standard output
+#   sqlite:addresses.db        table "records" in an SQLite database
+#   bern-address-book.parquet  Parquet file, see columnar.py
+#
+# Several sinks can be combined, and every record then goes to all of them.
+
+import csv
+import gzip
+import sqlite3
+import sys
+
+from columnar import COLUMNS, ParquetWriter
+
+
+def record_row(rec):
+    return [getattr(rec, c) for c in COLUMNS]
+
+
+class CSVSink(object):
+    # Writes records in batches, since csv.writer.writerows is faster
+    # than many calls to writerow.
+    def __init__(self, stream, batch_size=4096):
+        self.stream = stream
+        self.writer = csv.writer(stream, quoting=csv.QUOTE_MINIMAL)
+        self.writer.writerow(COLUMNS)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def write(self, rec):
+        self.rows.append(record_row(rec))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.stream is sys.stdout:
+            self.stream.flush()
+        else:
+            self.stream.close()
+
+
+class SQLiteSink(object):
+    def __init__(self, path, table='records', batch_size=4096):
+        self.db = sqlite3.connect(path)
+        self.table = table
+        self.batch_size = batch_size
+        self.rows = []
+        columns = ', '.join(
+            f'{c} REAL' if c in ('Latitude', 'Longitude') else f'{c} TEXT'
+            for c in COLUMNS)
+        self.db.execute(f'DROP TABLE IF EXISTS {table}')
+        self.db.execute(f'CREATE TABLE {table} ({columns})')
+        self.insert = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+
+    def write(self, rec):
+        self.rows.append(record_row(rec))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany(self.insert, self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.db.commit()
+        self.db.close()
+
+
+class TeeSink(object):
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, rec):
+        for sink in self.sinks:
+            sink.write(rec)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def open_sink(spec):
+    if spec == '-':
+        return CSVSink(sys.stdout)
+    if spec.startswith('sqlite:'):
+        return SQLiteSink(spec.removeprefix('sqlite:'))
+    if spec.endswith('.parquet'):
+        return ParquetWriter(spec)
+    if spec.endswith('.gz'):
+        return CSVSink(gzip.open(spec, 'wt', encoding='utf-8'))
+    return CSVSink(open(spec, 'w'))
+
+
+def open_sinks(specs):
+    sinks = [open_sink(spec) for spec in specs]
+    return sinks[0] if len(sinks) == 1 else TeeSink(sinks)
@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: MIT
+#
+# Writes a few records to both CSV and Parquet, and checks that reading
+# back the Parquet file gives the same rows as the CSV file.
+
+import csv
+
+import pytest
+
+from columnar import COLUMNS, ParquetWriter, compare_csv, read_parquet_rows
+from process import Record
+from sinks import CSVSink
+
+
+pytest.importorskip('pyarrow')
+
+
+RECORDS = [
+    Record(Name='Jgfr. Adele', Surname='Adam', Date='1861-04-15',
+           Street='Marktgasse', Housenumber='38', Postcode='3011',
+           City='Bern', Phone='', PageID='1395917', Page='63',
+           Latitude=46.92966, Longitude=7.45221),
+    Record(Name='L. G.', Surname='Aeschlimann', Date='1861-04-15',
+           Street='Zeughausgasse', Housenumber='11', Postcode='3011',
+           City='Bern', Phone='', PageID='1395918', Page='64',
+           Latitude=46.98145, Longitude=7.441451),
+    # Quoted in CSV, since the name contains a comma and a quote.
+    Record(Name='Anna, "Wwe."', Surname='von Graffenried',
+           Date='1900-12-15', Street='Kramgasse', Housenumber='59a',
+           Postcode='3011', City='Bern', Phone='2157;3408',
+           PageID='1396012', Page='[12]',
+           Latitude=46.947974, Longitude=7.451031),
+    # As emitted with --keep-unresolved, for an address that is not
+    # in the register.
+    Record(Name='Hans', Surname='Muster', Date='1900-12-15',
+           Street='Unbekanntgasse', Housenumber='3', Postcode='',
+           City='', Phone='', PageID='1396013', Page='13',
+           Latitude=None, Longitude=None),
+]
+
+
+def write_both(tmp_path):
+    csv_path = tmp_path / 'book.csv'
+    parquet_path = tmp_path / 'book.parquet'
+    csv_sink = CSVSink(open(csv_path, 'w', newline=''), batch_size=3)
+    with ParquetWriter(str(parquet_path)) as parquet_writer:
+        for rec in RECORDS:
+            csv_sink.write(rec)
+            parquet_writer.write(rec)
+    csv_sink.close()
+    return csv_path, parquet_path
+
+
+def test_parquet_rows_match_csv(tmp_path):
+    csv_path, parquet_path = write_both(tmp_path)
+    with open(csv_path, newline='') as stream:
+        csv_rows = list(csv.reader(stream))
+    assert csv_rows[0] == COLUMNS
+    assert list(read_parquet_rows(str(parquet_path))) == csv_rows[1:]
+    assert compare_csv(str(csv_path), str(parquet_path)) == len(RECORDS)
+
+
+def test_unresolved_coordinates_are_empty(tmp_path):
+    _, parquet_path = write_both(tmp_path)
+    last = dict(zip(COLUMNS, list(read_parquet_rows(str(parquet_path)))[-1]))
+    assert last['Latitude'] == last['Longitude'] == ''
+    assert last['Postcode'] == last['City'] == ''
+
+
+def test_one_row_group_per_date(tmp_path):
+    import pyarrow.parquet as pq
+    _, parquet_path = write_both(tmp_path)
+    assert pq.ParquetFile(str(parquet_path)).num_row_groups == 2
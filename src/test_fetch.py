@@ -0,0 +1,183 @@
+# SPDX-FileCopyrightText: 2023 Sascha Brawer <sascha@brawer.ch>
+# SPDX-License-Identifier: MIT
+#
+# Runs the fetcher against a local stub of e-rara, which serves a small
+# METS volume with two chapters and a few ALTO pages, and which fails
+# some requests with 503 errors or truncated bodies.
+
+import http.server
+import os
+import threading
+
+import pytest
+
+from fetch import Chapter, Extractor, Fetcher
+
+
+VOLUME_ID = 9900000
+
+# Physical page IDs, as linked from the two chapters of the volume.
+CHAPTER_PAGES = {
+    9900001: [9900011, 9900012, 9900013],
+    9900002: [9900021, 9900022],
+}
+
+METS = f'''<?xml version="1.0" encoding="UTF-8"?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/"
+           xmlns:xlink="http://www.w3.org/1999/xlink">
+  <mets:structMap TYPE="PHYSICAL">
+    <mets:div TYPE="physSequence">
+      {"".join(f'<mets:div ID="phys{p}" TYPE="page" ORDERLABEL="{i + 1}"/>'
+               for i, p in enumerate(sorted(p for pages in CHAPTER_PAGES.values()
+                                            for p in pages)))}
+    </mets:div>
+  </mets:structMap>
+  <mets:structLink>
+    {"".join(f'<mets:smLink xlink:from="log{c}" xlink:to="phys{p}"/>'
+             for c, pages in CHAPTER_PAGES.items() for p in pages)}
+  </mets:structLink>
+</mets:mets>
+'''.encode('utf-8')
+
+
+def alto_page(page_id):
+    lines = [f'Page{page_id} Hans, Schreiner,', 'Marktg. 5',
+             'Muster-', f'mann{page_id} Anna, Wwe., Aarbergerg. 12']
+    text_lines = ''.join(
+        '<TextLine>%s</TextLine>' % '<SP/>'.join(
+            f'<String CONTENT="{word}"/>' for word in line.split())
+        for line in lines)
+    return (f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<alto xmlns="http://www.loc.gov/standards/alto/ns-v3#">'
+            f'<Layout><Page><PrintSpace><TextBlock>{text_lines}'
+            f'</TextBlock></PrintSpace></Page></Layout></alto>').encode('utf-8')
+
+
+class StubServer(object):
+    def __init__(self):
+        # Number of requests per path, and per path the failures to
+        # inject before answering properly: '503' or 'truncate'.
+        self.hits, self.failures = {}, {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def document(self, path):
+        if path.startswith('/oai?'):
+            return METS
+        page_id = int(path.rsplit('/', 1)[-1])
+        return alto_page(page_id)
+
+    def handle(self, request):
+        with self.lock:
+            self.hits[request.path] = self.hits.get(request.path, 0) + 1
+            failures = self.failures.get(request.path, [])
+            failure = failures.pop(0) if failures else None
+        request.close_connection = True
+        if failure == '503':
+            request.send_error(503)
+            return
+        data = self.document(request.path)
+        request.send_response(200)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        if failure == 'truncate':
+            data = data[:len(data) // 2]
+        request.wfile.write(data)
+
+    def fail(self, path, *failures):
+        self.failures.setdefault(path, []).extend(failures)
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Extractor writes its output into proofread/ below the working directory.
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('proofread')
+    return tmp_path
+
+
+def make_extractor(stub, max_retries=3):
+    fetcher = Fetcher(max_workers=4, requests_per_second=1000.0,
+                      max_retries=max_retries, backoff=0.01)
+    return Extractor('cache', base_url=stub.url, fetcher=fetcher)
+
+
+def find_chapters(ex):
+    ex.prefetch_volumes([VOLUME_ID])
+    return [ex.find_chapter_pages(VOLUME_ID, c) for c in CHAPTER_PAGES]
+
+
+def page_path(ex, page_id):
+    return ex.page_xml_url(page_id).removeprefix(ex.base_url)
+
+
+def test_retries_503_and_truncated_bodies(stub, workdir):
+    ex = make_extractor(stub)
+    stub.fail(page_path(ex, 9900011), '503', 'truncate')
+    stub.fail(page_path(ex, 9900021), 'truncate')
+    pages = find_chapters(ex)
+    ex.prefetch_pages([p.id for chapter in pages for p in chapter])
+    assert stub.hits[page_path(ex, 9900011)] == 3
+    assert stub.hits[page_path(ex, 9900021)] == 2
+    assert ex.store.get('fulltext-9900011') == alto_page(9900011)
+    assert ex.store.get('fulltext-9900021') == alto_page(9900021)
+
+
+def test_prefetch_resumes(stub, workdir):
+    ex = make_extractor(stub, max_retries=2)
+    stub.fail(page_path(ex, 9900013), '503', '503')
+    pages = [p.id for chapter in find_chapters(ex) for p in chapter]
+    with pytest.raises(RuntimeError):
+        ex.prefetch_pages(pages)
+    assert 'fulltext-9900013' not in ex.store
+    assert 'fulltext-9900012' in ex.store
+
+    # A second run only fetches what is still missing.
+    ex = make_extractor(stub)
+    ex.prefetch_pages(pages)
+    for page_id in pages:
+        expected = 3 if page_id == 9900013 else 1
+        assert stub.hits[page_path(ex, page_id)] == expected
+    assert ex.store.get('fulltext-9900013') == alto_page(9900013)
+
+
+def test_extract_chapters_same_with_workers(stub, workdir):
+    ex = make_extractor(stub)
+    stub.fail(page_path(ex, 9900022), 'truncate', '503')
+    chapters = [
+        Chapter(id=c, title=f'Chapter {c}', date=f'1900-0{i + 1}-01',
+                year='1900', volume=VOLUME_ID, pages=pages)
+        for i, (c, pages) in enumerate(zip(CHAPTER_PAGES, find_chapters(ex)))]
+    ex.prefetch_pages([p.id for c in chapters for p in c.pages])
+
+    outputs = {}
+    for workers in (1, 3):
+        ex.extract_chapters(chapters, workers=workers)
+        outputs[workers] = {c.date: (workdir / 'proofread' / f'{c.date}.txt')
+                            .read_text() for c in chapters}
+        for path in (workdir / 'proofread').iterdir():
+            path.unlink()
+    assert outputs[1] == outputs[3]
+    first = outputs[1]['1900-01-01'].splitlines()
+    assert first[0] == '# Date: 1900-01-01 Page: 9900011/1'
+    assert first[1] == 'Page9900011 Hans, Schreiner, Marktg. 5'
+    assert first[2] == 'Mustermann9900011 Anna, Wwe., Aarbergerg. 12'
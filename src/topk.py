@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: MIT
+#
+# Bounded-memory replacement for collections.Counter, for counting
+# unknown names over the whole corpus without memory growing with it.
+
+import heapq
+
+
+class TopKCounter(object):
+    # Keeps approximate counts for at most `capacity` keys, using the
+    # Space-Saving algorithm by Metwally, Agrawal and El Abbadi (2005).
+    # A key that is not tracked counts as the current minimum, so that
+    # `counter[key] += 1` evicts the least frequent key and lets the new
+    # key inherit its count. Frequent keys are never evicted, and no
+    # count is too high by more than the minimum count at eviction time.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []  # (count, key), possibly stale
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __getitem__(self, key):
+        if key in self.counts:
+            return self.counts[key]
+        if len(self.counts) < self.capacity:
+            return 0
+        return self.min_count()
+
+    def __setitem__(self, key, count):
+        if key not in self.counts and len(self.counts) >= self.capacity:
+            self.min_count()
+            _, evicted = heapq.heappop(self.heap)
+            del self.counts[evicted]
+        self.counts[key] = count
+        heapq.heappush(self.heap, (count, key))
+        # Stale heap entries are dropped once they outnumber live ones,
+        # which keeps the heap bounded at amortized constant cost.
+        if len(self.heap) > 2 * self.capacity + 16:
+            self.heap = [(c, k) for k, c in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def min_count(self):
+        # Discards stale entries until the top of the heap is current.
+        while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+    def items(self):
+        return self.counts.items()
+
+    def update(self, other):
+        for key, count in other.items():
+            self[key] += count
+
+    def most_common(self, n=None):
+        result = sorted(self.counts.items(), key=lambda kv: -kv[1])
+        return result if n is None else result[:n]
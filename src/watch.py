@@ -0,0 +1,193 @@
+# SPDX-License-Identifier: MIT
+#
+# Watch mode for proofreading: keeps one Processor in memory, polls the
+# proofread volumes for changes, and re-parses just the pages whose text
+# has changed. After each save, the yield stats of the touched volume
+# are printed right away, without loading the lookup tables again and
+# without parsing the other volumes. For example:
+#
+#   python3 src/watch.py --output bern-address-book.csv
+#
+# The output file, if any, is rewritten after every change.
+
+import argparse
+import csv
+import hashlib
+import io
+import os
+import sys
+import time
+
+from columnar import COLUMNS
+from pageindex import volume_stamp
+from process import Processor, percent
+from sinks import open_sinks, record_row
+
+
+class Watcher(object):
+    def __init__(self, processor, outputs=None):
+        self.p = processor
+        self.outputs = outputs
+        self.index = processor.page_index()
+        self.stamps = {}  # volume path -> (size, mtime)
+        self.pages = {}  # page id -> (digest, records, stats, csv text)
+        self.volume_pages = {}  # volume path -> [page id]
+
+    def poll(self):
+        # Returns the volumes that changed since the last call,
+        # after re-parsing their changed pages.
+        paths = self.p.volume_paths()
+        changed = []
+        for path in paths:
+            stamp = volume_stamp(path)
+            if self.stamps.get(path) != stamp:
+                self.stamps[path] = stamp
+                changed.append(path)
+        removed = [path for path in self.volume_pages if path not in paths]
+        for path in removed:
+            del self.stamps[path]
+            for page_id in self.volume_pages.pop(path):
+                self.pages.pop(page_id, None)
+        if changed or removed:
+            self.index.volume_paths = {os.path.basename(p): p for p in paths}
+            self.index.update()
+        result = []
+        for path in changed:
+            start = time.perf_counter()
+            try:
+                num_parsed = self.update_volume(path)
+            except ValueError as e:
+                # Typically a typo in a header line; the volume gets
+                # parsed again when the proofreader saves the fix.
+                print(f'error: {e}', file=sys.stderr)
+                continue
+            result.append((path, num_parsed, time.perf_counter() - start))
+        return result
+
+    def update_volume(self, path):
+        page_ids = self.index.volume_page_ids(path)
+        # The page index only knows about lines after a page header.
+        end = self.index.locate(page_ids[0]).Start if page_ids else None
+        with open(path, 'rb') as f:
+            if f.read(end).strip():
+                raise ValueError(f'{path}: Record before first page header')
+        todo = []
+        for page_id in page_ids:
+            loc = self.index.locate(page_id)
+            text = self.index.read_page(loc)
+            digest = hashlib.sha256(text.encode('utf-8')).digest()
+            if (page := self.pages.get(page_id)) and page[0] == digest:
+                continue
+            todo.append((page_id, digest))
+        # Parse all changed pages before storing any result, so that
+        # a page with an error leaves the volume as it was.
+        parsed = [(page_id, digest, self.p.run_pages([page_id], self.index))
+                  for page_id, digest in todo]
+        for page_id, digest, (records, stats) in parsed:
+            self.pages[page_id] = (digest, records, stats,
+                                   render_csv(records))
+        for page_id in self.volume_pages.get(path, []):
+            if page_id not in page_ids:
+                self.pages.pop(page_id, None)
+        self.volume_pages[path] = page_ids
+        return len(todo)
+
+    def volume_summary(self, path):
+        totals = {'num_input_records': 0, 'num_output_records': 0,
+                  'good_familyname_count': 0, 'bad_familyname_count': 0,
+                  'good_firstname_count': 0, 'bad_firstname_count': 0}
+        for page_id in self.volume_pages.get(path, []):
+            if not (page := self.pages.get(page_id)):
+                continue
+            _, records, stats, _ = page
+            totals['num_output_records'] += len(records)
+            for name in totals:
+                if name in stats:
+                    totals[name] += stats[name]
+        return totals
+
+    def current_pages(self):
+        for path in sorted(self.volume_pages):
+            for page_id in self.volume_pages[path]:
+                if page := self.pages.get(page_id):
+                    yield page
+
+    def write_outputs(self):
+        # CSV files get assembled from the pre-rendered text of each page,
+        # which is much faster than formatting all records again.
+        for output in self.outputs:
+            if not output.endswith('.csv'):
+                continue
+            with open(output + '.tmp', 'w') as f:
+                f.write(render_csv([COLUMNS], row=list))
+                for page in self.current_pages():
+                    f.write(page[3])
+            os.rename(output + '.tmp', output)  # atomic
+        if others := [o for o in self.outputs if not o.endswith('.csv')]:
+            sink = open_sinks(others)
+            for page in self.current_pages():
+                for rec in page[1]:
+                    sink.write(rec)
+            sink.close()
+
+    def run(self, interval):
+        while True:
+            changed = self.poll()
+            for path, num_parsed, seconds in changed:
+                print(format_summary(path, num_parsed, seconds,
+                                     self.volume_summary(path)))
+            if changed and self.outputs:
+                start = time.perf_counter()
+                self.write_outputs()
+                print(f'wrote {", ".join(self.outputs)} in '
+                      f'{time.perf_counter() - start:.2f}s')
+            sys.stdout.flush()
+            time.sleep(interval)
+
+
+def render_csv(records, row=record_row):
+    # Formats records exactly like the CSV sink of process.py.
+    out = io.StringIO()
+    csv.writer(out).writerows(row(r) for r in records)
+    return out.getvalue()
+
+
+def format_summary(path, num_parsed, seconds, s):
+    volume = os.path.basename(path).removesuffix('.txt')
+    num_families = s['good_familyname_count'] + s['bad_familyname_count']
+    num_firstnames = s['good_firstname_count'] + s['bad_firstname_count']
+    return (f'{volume}: parsed {num_parsed} pages in {seconds:.2f}s; '
+            f'records {s["num_input_records"]} -> {s["num_output_records"]} = '
+            f'{percent(s["num_output_records"], s["num_input_records"])}%; '
+            f'family names known '
+            f'{percent(s["good_familyname_count"], num_families)}%; '
+            f'firstnames known '
+            f'{percent(s["good_firstname_count"], num_firstnames)}%')
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--interval', type=float, default=0.5,
+        help='seconds between checks for changed volumes; default: %(default)s')
+    argparser.add_argument(
+        '--output', metavar='SPEC', action='append',
+        help='also keep the address book up to date, see sinks.py')
+    argparser.add_argument(
+        '--fuzzy-streets', action='store_true',
+        help='accept OCR-damaged street names close to a known street')
+    args = argparser.parse_args()
+    start = time.perf_counter()
+    p = Processor(cachedir='cache', fuzzy_streets=args.fuzzy_streets)
+    watcher = Watcher(p, args.output)
+    # The first poll finds all volumes changed, which parses everything.
+    watcher.poll()
+    if args.output:
+        watcher.write_outputs()
+    print(f'watching {len(watcher.volume_pages)} volumes, '
+          f'started in {time.perf_counter() - start:.1f}s')
+    sys.stdout.flush()
+    try:
+        watcher.run(args.interval)
+    except KeyboardInterrupt:
+        pass